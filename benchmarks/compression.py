@@ -0,0 +1,43 @@
+"""
+CPU cost vs bytes saved by compressing encoded payloads, across payload sizes.
+
+    python benchmarks/compression.py
+
+`cpu` is the time spent compressing and decompressing one payload, `saved` the bytes it no longer puts on the wire.
+Compression pays off when the link is slower than `break-even`: saved bytes / extra cpu time. Links faster than that
+(e.g. within a cluster) are better off sending the payload raw, which is what the threshold is for.
+"""
+import timeit
+
+from miteD import codecs
+
+
+def make_payload(size):
+    item = {'run_id': 'run-000123', 'channel': 42, 'state': 'sequencing', 'mean_current': 81.25, 'events': 17}
+    count = max(1, size // len(codecs.encode(item)))
+    return [dict(item, index=i) for i in range(count)]
+
+
+def main(sizes=(256, 1024, 4096, 16384, 65536, 262144, 1048576)):
+    print('{:>6} {:>9} {:>10} {:>6} {:>10} {:>10} {:>12}'.format(
+        '', 'bytes', 'compressed', 'ratio', 'cpu us', 'saved', 'break-even'
+    ))
+    for size in sizes:
+        payload = make_payload(size)
+        raw = codecs.encode(payload)
+        for name in codecs.get_compressor_names():
+            compressor = codecs.get_compressor(name)
+            compressed = compressor.compress(raw)
+            number = max(10, 2000000 // len(raw))
+            cpu = (
+                timeit.timeit(lambda: compressor.compress(raw), number=number) +
+                timeit.timeit(lambda: compressor.decompress(compressed), number=number)
+            ) / number
+            saved = len(raw) - len(compressed)
+            print('{:>6} {:>9} {:>10} {:>6.2f} {:>10.1f} {:>10} {:>7.1f} MB/s'.format(
+                name, len(raw), len(compressed), len(raw) / len(compressed), cpu * 1e6, saved, saved / cpu / 1e6
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Per-message cost of resolving an RPC subject to its handler.
+
+    python benchmarks/dispatch.py
+
+`legacy` is the lookup rpc_service did before the dispatch table: split the subject twice and walk the per-version
+endpoint dicts with '*' fallbacks. `table` is the single dict lookup done by Service._get_handler now.
+"""
+import timeit
+
+from miteD.service.service import rpc_service, rpc_method
+
+
+@rpc_service(name='bench', versions=['1.0', '1.1', '2.0'])
+class BenchService:
+    @rpc_method()
+    async def ping(self):
+        return 'pong'
+
+    @rpc_method(versions=['1.1'])
+    async def add(self, x, y):
+        return x + y
+
+    @rpc_method(name='add', versions=['2.0'])
+    async def add_2_0(self, x, y):
+        return x + y
+
+
+def legacy_get_handler(endpoints, subject):
+    api_version = subject.split('.')[3]
+    api_method = subject.split('.')[4]
+    api = endpoints.get(api_version, endpoints['*'])
+    method = api.get(api_method, endpoints['*'].get(api_method, None))
+    if method:
+        return method
+    else:
+        raise NotImplementedError(subject)
+
+
+def main(number=1000000):
+    service = BenchService()
+    subjects = ['rpc.service.bench.1_0.ping', 'rpc.service.bench.1_1.add', 'rpc.service.bench.2_0.add']
+    for subject in subjects:
+        assert legacy_get_handler(service.endpoints, subject) == service._get_handler(subject)
+        legacy = timeit.timeit(lambda: legacy_get_handler(service.endpoints, subject), number=number)
+        table = timeit.timeit(lambda: service._get_handler(subject), number=number)
+        print('{:<32} legacy {:7.1f} ns/msg   table {:7.1f} ns/msg   x{:.1f}'.format(
+            subject, legacy / number * 1e9, table / number * 1e9, legacy / table
+        ))
+
+
+if __name__ == '__main__':
+    main()
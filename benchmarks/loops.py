@@ -0,0 +1,77 @@
+"""
+Request/reply throughput of the event loop implementations selectable with `loop_policy`.
+
+    python benchmarks/loops.py
+
+Each round trip goes over a loopback TCP connection and does what a service does per message: decode the request
+envelope, await the handler and encode the reply. `clients` connections run concurrently. The broker is left out so
+the difference comes from the loop alone, uvloop is skipped when it is not installed.
+"""
+import asyncio
+import struct
+import time
+
+from miteD import codecs, loops
+from miteD.service.envelope import build_request, parse_request
+
+_LENGTH = struct.Struct('!I')
+
+
+async def read_frame(reader):
+    size, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return await reader.readexactly(size)
+
+
+def write_frame(writer, data):
+    writer.write(_LENGTH.pack(len(data)) + data)
+
+
+async def handler(x, y):
+    return x + y
+
+
+async def serve(reader, writer):
+    try:
+        while True:
+            codec, request = codecs.decode(await read_frame(reader))
+            args, _ = parse_request(request)
+            write_frame(writer, codecs.encode({'status': 200, 'body': await handler(*args)}, codec))
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+
+async def client(port, messages):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for i in range(messages):
+        write_frame(writer, codecs.encode(build_request([i, 1])))
+        codecs.decode(await read_frame(reader))
+    writer.close()
+
+
+async def run(clients, messages):
+    server = await asyncio.start_server(serve, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, messages) for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def main(clients=32, messages=2000):
+    policies = [loops.ASYNCIO] + ([loops.UVLOOP] if loops.uvloop is not None else [])
+    baseline = None
+    for policy in policies:
+        loop = loops.new_event_loop(policy)
+        try:
+            elapsed = loop.run_until_complete(run(clients, messages))
+        finally:
+            loop.close()
+        rate = clients * messages / elapsed
+        baseline = baseline or rate
+        print('{:<8} {:>9.0f} msg/s   {:6.1f} us/msg   x{:.2f}'.format(policy, rate, 1e6 / rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
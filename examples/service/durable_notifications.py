@@ -0,0 +1,64 @@
+import logging
+
+from miteD.service.service import rpc_service, rpc_method
+from miteD import notification_handler
+
+
+"""
+Needs a NATS Streaming server next to the broker, e.g.:
+    nats-streaming-server -cid test-cluster
+"""
+
+
+@rpc_service(
+    name='durable_producer',
+    versions=['1.0'],
+    broker_urls=['nats://127.0.0.1:4222'],
+    notification_topics=['runs'],
+    streaming_cluster='test-cluster',
+    durable_topics=['runs'],
+)
+class DurableProducer:
+    """
+    Notifications on the 'runs' topic are persisted by the streaming server, notify returns once they are stored.
+    """
+    @rpc_method()
+    async def finish_run(self, run_id):
+        await self.notify.runs({'run_id': run_id, 'state': 'finished'})
+        return run_id
+
+
+@rpc_service(
+    name='durable_consumer',
+    versions=['1.0'],
+    broker_urls=['nats://127.0.0.1:4222'],
+    streaming_cluster='test-cluster',
+)
+class DurableConsumer:
+    """
+    Gets every notification on "notification.service.durable_producer.runs", including the ones published while it
+    was down. The first time it starts it replays all of them (deliver_all), afterwards it resumes where it left off.
+    A notification is acknowledged once the handler returns, raising makes the server deliver it again.
+    """
+    @notification_handler(
+        layer='service',
+        producer='durable_producer',
+        topic='runs',
+        durable_name='runs_archive',
+        max_inflight=16,
+        deliver_all=True,
+    )
+    async def runs_handler(self, channel, msg):
+        logging.debug("runs_handler: got notification from channel: {} msg = '{}'".format(channel, msg))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    test = DurableConsumer()
+
+    try:
+        logging.info("Starting DurableConsumer")
+        test.start()
+    except KeyboardInterrupt:
+        logging.info("Stopping DurableConsumer")
+        test.stop()
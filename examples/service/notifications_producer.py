@@ -1,5 +1,6 @@
 import logging
 import asyncio
+import threading
 from miteD.service.service import rpc_service, rpc_method
 from nats.aio.client import Client as NatsClient
 from miteD.service.client import RemoteService
@@ -69,8 +70,9 @@ async def main(loop):
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     test = NotificationsProducer()
-    loop = asyncio.get_event_loop()
-    task = loop.create_task(main(loop))
+    # The service runs its own loop once started, the client gets one in a thread of its own.
+    client_loop = asyncio.new_event_loop()
+    threading.Thread(target=client_loop.run_until_complete, args=(main(client_loop),), daemon=True).start()
 
     try:
         logging.info("Starting NotificationsProducer")
@@ -15,6 +15,10 @@ async def main(loop):
     print(await client_2_0.ping())
     print(await client_2_0.hello('world'))
     print(await client_2_0.add(12, 54))
+    async with client_2_0.batch() as batch:
+        sums = [batch.add(x, x) for x in range(10)]
+        greeting = batch.hello('batch')
+    print([await s for s in sums], await greeting)
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
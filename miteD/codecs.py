@@ -0,0 +1,240 @@
+import datetime
+import json
+import zlib
+
+from .utils import CustomJsonEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+CODEC_MARKER = b'\x00'
+# Payloads encoded with a marked codec start with this byte followed by the codec id. No JSON text can start with
+# it, so unmarked payloads are plain JSON and peers that predate the registry keep understanding each other.
+
+DEFAULT_CODEC = 'json'
+
+COMPRESSION_MARKER = b'\x01'
+# Compressed payloads start with this byte followed by the compressor id, the compressed data is an encoded payload.
+
+DEFAULT_COMPRESSION_THRESHOLD = 4096
+# Payloads smaller than this are not worth compressing, see benchmarks/compression.py.
+
+DEFAULT_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+# Largest size a compressed payload may expand to, so a small message can not exhaust the receiver's memory.
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec:
+    """
+    The original wire format, unmarked. Uses a single encoder instance instead of building one per message.
+    """
+    name = 'json'
+    id = None
+
+    def __init__(self):
+        self._encoder = CustomJsonEncoder()
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, obj):
+        return self._encoder.encode(obj).encode()
+
+    def decode(self, data):
+        return self._decoder.decode(bytes(data).decode())
+
+
+class OrjsonCodec:
+    """
+    Produces plain JSON, so it needs no marker and any JSON peer can read it.
+    """
+    name = 'orjson'
+    id = None
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.astimezone(datetime.timezone.utc).isoformat()
+        raise TypeError
+
+    def encode(self, obj):
+        return orjson.dumps(obj, default=self._default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    id = 1
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.astimezone(datetime.timezone.utc).isoformat()
+        raise TypeError('Object of type {} is not MessagePack serializable'.format(type(obj).__name__))
+
+    def encode(self, obj):
+        return msgpack.packb(obj, default=self._default, use_bin_type=True)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (ValueError, msgpack.UnpackException) as err:
+            raise CodecError(str(err))
+
+
+class ZlibCompressor:
+    name = 'zlib'
+    id = 1
+
+    def __init__(self, level=6):
+        self._level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self._level)
+
+    def decompress(self, data, max_size=DEFAULT_MAX_DECOMPRESSED_SIZE):
+        decompressor = zlib.decompressobj()
+        try:
+            decompressed = decompressor.decompress(data, max_size)
+        except zlib.error as err:
+            raise CodecError(str(err))
+        if decompressor.unconsumed_tail:
+            raise CodecError('Payload decompresses to more than {} bytes'.format(max_size))
+        if not decompressor.eof:
+            raise CodecError('Truncated compressed payload')
+        return decompressed
+
+
+class Compression:
+    """
+    Compress encoded payloads of at least `threshold` bytes with the named compressor.
+    """
+    def __init__(self, compressor='zlib', threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        self.compressor = get_compressor(compressor)
+        self.threshold = threshold
+
+    @classmethod
+    def get(cls, setting):
+        """
+        Accepts a Compression, a compressor name or None (no compression).
+        """
+        if setting is None or isinstance(setting, cls):
+            return setting
+        return cls(setting)
+
+
+_codecs = {}
+_codecs_by_id = {}
+_compressors = {}
+_compressors_by_id = {}
+
+
+def register_codec(codec):
+    """
+    Makes a codec available by name. Codecs with an `id` (0-255) are marked on the wire, codecs without one must
+    produce JSON.
+    """
+    _codecs[codec.name] = codec
+    if codec.id is not None:
+        _codecs_by_id[codec.id] = codec
+    return codec
+
+
+def get_codec(name=None):
+    if name is None:
+        name = DEFAULT_CODEC
+    if not isinstance(name, str):
+        return name
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError('Unknown or unavailable codec: "{}" (available: {})'.format(name, ', '.join(_codecs)))
+
+
+def register_compressor(compressor):
+    """
+    Makes a compressor available by name, its `id` (0-255) marks the payloads it compressed.
+    """
+    _compressors[compressor.name] = compressor
+    _compressors_by_id[compressor.id] = compressor
+    return compressor
+
+
+def get_compressor(name):
+    if not isinstance(name, str):
+        return name
+    try:
+        return _compressors[name]
+    except KeyError:
+        raise ValueError('Unknown compressor: "{}" (available: {})'.format(name, ', '.join(_compressors)))
+
+
+def get_compressor_names():
+    return list(_compressors)
+
+
+def encode(obj, codec=None, compression=None, prefix=b''):
+    """
+    `prefix` goes in front of the encoded payload, inside the compression.
+    """
+    codec = get_codec(codec)
+    if codec.id is None:
+        data = prefix + codec.encode(obj)
+    else:
+        data = prefix + CODEC_MARKER + bytes((codec.id, )) + codec.encode(obj)
+    if compression is not None and len(data) >= compression.threshold:
+        compressor = compression.compressor
+        compressed = compressor.compress(data)
+        if len(compressed) + 2 < len(data):
+            return COMPRESSION_MARKER + bytes((compressor.id, )) + compressed
+    return data
+
+
+def decompress(data, max_size=DEFAULT_MAX_DECOMPRESSED_SIZE):
+    """
+    The encoded payload of `data`, which may be compressed. Raises a CodecError when it would expand beyond `max_size`.
+    """
+    if data[:1] != COMPRESSION_MARKER:
+        return data
+    try:
+        compressor = _compressors_by_id[data[1]]
+    except (IndexError, KeyError):
+        raise CodecError('Unknown compressor marker in payload')
+    return compressor.decompress(memoryview(data)[2:], max_size)
+
+
+def decode(data, codec=None, max_size=DEFAULT_MAX_DECOMPRESSED_SIZE):
+    """
+    Returns the codec the payload was encoded with together with the decoded payload. Unmarked payloads are JSON and
+    are read with `codec` when that is a JSON codec, so replies can be sent back with the same codec.
+    """
+    data = decompress(data, max_size)
+    if data[:1] != CODEC_MARKER:
+        codec = get_codec(codec)
+        if codec.id is not None:
+            codec = _json
+        return codec, codec.decode(data)
+    try:
+        codec = _codecs_by_id[data[1]]
+    except (IndexError, KeyError):
+        raise CodecError('Unknown codec marker in payload')
+    return codec, codec.decode(memoryview(data)[2:])
+
+
+_json = register_codec(JsonCodec())
+register_compressor(ZlibCompressor())
+if orjson is not None:
+    register_codec(OrjsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
@@ -0,0 +1,79 @@
+import asyncio
+import itertools
+from zlib import crc32
+
+from nats.aio.client import Client as NATS
+
+
+class ConnectionPool:
+    """
+    A fixed number of broker connections behind the subset of the NATS client interface miteD uses. Each subject is
+    always handled by the same connection (stable hashing), so messages on one subject keep their order.
+
+    The broker gives no ordering across connections, so subscribe only returns once the broker has the subscription:
+    a message published right after, on whichever connection, to a peer that answers on the subscribed subject (a
+    reply inbox, a chunk upload subject, ...) can not reach it first.
+    """
+    def __init__(self, size=2, client_factory=NATS):
+        self._connections = [client_factory() for _ in range(size)]
+        self._sids = {}
+        self._next_sid = itertools.count(1)
+
+    def __len__(self):
+        return len(self._connections)
+
+    @property
+    def connections(self):
+        return list(self._connections)
+
+    @property
+    def is_connected(self):
+        return all(nc.is_connected for nc in self._connections)
+
+    def get_connection(self, subject):
+        return self._connections[crc32(subject.encode()) % len(self._connections)]
+
+    async def connect(self, name=None, **options):
+        await asyncio.gather(*[
+            nc.connect(name='{}-{}'.format(name, index) if name else None, **options)
+            for index, nc in enumerate(self._connections)
+        ])
+
+    async def subscribe(self, subject, queue='', cb=None, **options):
+        nc = self.get_connection(subject)
+        sid = self._add_sid((nc, await nc.subscribe(subject, queue=queue, cb=cb, **options)))
+        await nc.flush()
+        return sid
+
+    async def subscribe_spread(self, subject, queue, cb=None, **options):
+        """
+        Joins the queue group on every connection, spreading the subject's messages over all of them. Messages are no
+        longer delivered in order.
+        """
+        nc_sids = await asyncio.gather(*[
+            nc.subscribe(subject, queue=queue, cb=cb, **options) for nc in self._connections
+        ])
+        return self._add_sid(*zip(self._connections, nc_sids))
+
+    async def unsubscribe(self, sid, max_msgs=0):
+        await asyncio.gather(*[nc.unsubscribe(nc_sid, max_msgs=max_msgs) for nc, nc_sid in self._sids.pop(sid)])
+
+    async def publish(self, subject, payload):
+        await self.get_connection(subject).publish(subject, payload)
+
+    async def publish_request(self, subject, reply, payload):
+        await self.get_connection(subject).publish_request(subject, reply, payload)
+
+    async def timed_request(self, subject, payload, timeout=0.5):
+        return await self.get_connection(subject).timed_request(subject, payload, timeout=timeout)
+
+    async def flush(self, timeout=60):
+        await asyncio.gather(*[nc.flush(timeout) for nc in self._connections])
+
+    async def close(self):
+        await asyncio.gather(*[nc.close() for nc in self._connections])
+
+    def _add_sid(self, *subscriptions):
+        sid = next(self._next_sid)
+        self._sids[sid] = subscriptions
+        return sid
@@ -0,0 +1,126 @@
+import asyncio
+import dis
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+
+THREAD = 'thread'
+PROCESS = 'process'
+EXECUTOR_KINDS = (THREAD, PROCESS)
+
+_process_handlers = {}
+# Handlers run in the process pool are looked up by name in the worker instead of being pickled, since the classes
+# they are defined on are replaced by the rpc_service/api wrappers. The workers only know them because they are forked
+# from the service process, hence the 'fork' start method of the pool.
+
+
+def _handler_key(fn):
+    return '{}:{}'.format(fn.__module__, fn.__qualname__)
+
+
+def _run_process_handler(key, *args):
+    return _process_handlers[key](None, *args)
+
+
+_LOCAL_LOADS = ('LOAD_FAST', 'LOAD_FAST_CHECK', 'LOAD_FAST_AND_CLEAR', 'LOAD_FAST_LOAD_FAST', 'LOAD_DEREF')
+
+
+def _uses_self(fn):
+    """
+    Whether the function reads its first argument, directly or from a closure.
+    """
+    code = fn.__code__
+    if not code.co_argcount:
+        return False
+    name = code.co_varnames[0]
+    if name in code.co_cellvars:
+        return True
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in _LOCAL_LOADS and name in (
+            instruction.argval if isinstance(instruction.argval, tuple) else (instruction.argval,)
+        ):
+            return True
+    return False
+
+
+def set_executor(fn, kind):
+    """
+    Marks a plain (non-async) handler to be run in one of the managed pools. Handlers run in the process pool get
+    `None` instead of the service instance as `self`, so they must only depend on their arguments; a TypeError is
+    raised for those that use `self`.
+    """
+    if kind is None:
+        return fn
+    if kind not in EXECUTOR_KINDS:
+        raise ValueError('Unknown executor "{}", expected one of {}'.format(kind, EXECUTOR_KINDS))
+    if asyncio.iscoroutinefunction(fn):
+        raise TypeError('"{}" runs in the {} pool and can not be a coroutine function'.format(fn.__name__, kind))
+    if kind == PROCESS and _uses_self(fn):
+        raise TypeError('"{}" runs in the process pool and can not use self'.format(fn.__name__))
+    fn.__executor__ = kind
+    if kind == PROCESS:
+        _process_handlers[_handler_key(fn)] = fn
+    return fn
+
+
+def get_executor(fn):
+    return getattr(fn, '__executor__', None)
+
+
+class Executors:
+    """
+    Lazily created thread and process pools shared by the handlers of one service or api.
+    """
+    def __init__(self, thread_pool_size=None, process_pool_size=None):
+        self._sizes = {
+            THREAD: thread_pool_size or min(32, (os.cpu_count() or 1) + 4),
+            PROCESS: process_pool_size or os.cpu_count() or 1,
+        }
+        self._pools = {}
+        self._in_flight = {THREAD: 0, PROCESS: 0}
+
+    def _get_pool(self, kind):
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == THREAD:
+                pool = ThreadPoolExecutor(max_workers=self._sizes[kind])
+            else:
+                pool = ProcessPoolExecutor(
+                    max_workers=self._sizes[kind], mp_context=multiprocessing.get_context('fork')
+                )
+            self._pools[kind] = pool
+        return pool
+
+    async def call(self, fn, instance, *args):
+        kind = fn.__executor__
+        if kind == PROCESS:
+            call = partial(_run_process_handler, _handler_key(fn), *args)
+        else:
+            call = partial(fn, instance, *args)
+        self._in_flight[kind] += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._get_pool(kind), call)
+        finally:
+            self._in_flight[kind] -= 1
+
+    def queue_depth(self, kind):
+        """
+        Number of calls submitted to the pool that are waiting for a free worker.
+        """
+        return max(0, self._in_flight[kind] - self._sizes[kind])
+
+    def stats(self):
+        return {
+            kind: {
+                'workers': self._sizes[kind],
+                'in_flight': self._in_flight[kind],
+                'queued': self.queue_depth(kind),
+            } for kind in EXECUTOR_KINDS
+        }
+
+    def shutdown(self, wait=False):
+        for pool in self._pools.values():
+            pool.shutdown(wait=wait)
+        self._pools = {}
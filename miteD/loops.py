@@ -0,0 +1,46 @@
+import asyncio
+import logging
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - optional dependency
+    uvloop = None
+
+
+ASYNCIO = 'asyncio'
+UVLOOP = 'uvloop'
+
+_logger = logging.getLogger('mited.loops')
+
+
+def get_loop_policy(policy=None):
+    """
+    Resolves the `loop_policy` setting of rpc_service / api: None picks uvloop when it is installed and asyncio's loop
+    otherwise, a name picks one of them (uvloop falls back to asyncio when it is missing) and an
+    asyncio.AbstractEventLoopPolicy is used as is.
+    """
+    if isinstance(policy, asyncio.AbstractEventLoopPolicy):
+        return policy
+    if policy is None:
+        policy = UVLOOP if uvloop is not None else ASYNCIO
+    if policy == UVLOOP:
+        if uvloop is not None:
+            return uvloop.EventLoopPolicy()
+        _logger.warning('uvloop is not installed, falling back to the asyncio event loop')
+        policy = ASYNCIO
+    if policy == ASYNCIO:
+        return asyncio.DefaultEventLoopPolicy()
+    raise ValueError('Unknown event loop policy {!r}'.format(policy))
+
+
+def new_event_loop(policy=None, slow_callback_duration=None):
+    """
+    Creates an event loop from the given policy and makes it the current one. With `slow_callback_duration` (seconds)
+    the loop runs in debug mode and logs every callback that blocks it for longer than that.
+    """
+    loop = get_loop_policy(policy).new_event_loop()
+    if slow_callback_duration is not None:
+        loop.set_debug(True)
+        loop.slow_callback_duration = slow_callback_duration
+    asyncio.set_event_loop(loop)
+    return loop
@@ -0,0 +1,207 @@
+import os
+import socket
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds in seconds.
+
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+# Upper bounds in bytes.
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Fixed bucket histogram: one count per bucket (plus the +Inf one), the sum and the total count.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', '+Inf' if bound == float('inf') else bound),), cumulative
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Family:
+    """
+    The metrics of one name, one per combination of label values.
+    """
+    def __init__(self, name, documentation, kind, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._buckets = buckets
+        self._children = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if self.kind == 'histogram':
+                child = Histogram(self._buckets)
+            elif self.kind == 'gauge':
+                child = Gauge()
+            else:
+                child = Counter()
+            self._children[values] = child
+        return child
+
+    def render(self, extra_labels=()):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, child in list(self._children.items()):
+            for name, labels, value in child.samples(self.name, ()):
+                label_text = _format_labels(self.labelnames, values, tuple(extra_labels) + labels)
+                lines.append('{}{} {}'.format(name, label_text, _format_value(value)))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._families = {}
+
+    def _add(self, name, documentation, kind, labelnames, buckets=None):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = Family(name, documentation, kind, labelnames, buckets)
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(name, documentation, 'counter', labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(name, documentation, 'gauge', labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(name, documentation, 'histogram', labelnames, tuple(buckets))
+
+    def render(self, extra_labels=()):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for family in self._families.values():
+            lines.extend(family.render(extra_labels))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+# Metrics of this process, shared by all services and apis running in it.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def get_metrics_subject(layer, name):
+    """
+    Every process of a service answers requests on this subject with its metrics, see render_reply.
+    """
+    return 'metrics.{}.{}'.format(layer, name)
+
+
+def get_instance():
+    # Evaluated on each call, prefork workers share the module but not the pid.
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def render_reply():
+    instance = get_instance()
+    return {'instance': instance, 'metrics': REGISTRY.render((('instance', instance),))}
+
+
+rpc_server_latency = REGISTRY.histogram(
+    'mited_rpc_server_latency_seconds', 'Time spent handling an RPC request.', ('subject',)
+)
+rpc_server_requests = REGISTRY.counter(
+    'mited_rpc_server_requests_total', 'RPC replies sent, by status.', ('subject', 'status')
+)
+rpc_server_request_size = REGISTRY.histogram(
+    'mited_rpc_server_request_bytes', 'Size of RPC requests.', ('subject',), SIZE_BUCKETS
+)
+rpc_server_reply_size = REGISTRY.histogram(
+    'mited_rpc_server_reply_bytes', 'Size of RPC replies.', ('subject',), SIZE_BUCKETS
+)
+rpc_server_in_flight = REGISTRY.gauge('mited_rpc_server_in_flight', 'RPC requests being handled.', ('service',))
+rpc_server_shed = REGISTRY.counter('mited_rpc_server_shed_total', 'RPC requests shed with a 503.', ('service',))
+rpc_server_expired = REGISTRY.counter(
+    'mited_rpc_server_expired_total', 'RPC requests dropped past their deadline.', ('subject',)
+)
+
+rpc_client_latency = REGISTRY.histogram(
+    'mited_rpc_client_latency_seconds', 'Time waited for RPC replies.', ('method',)
+)
+rpc_client_requests = REGISTRY.counter(
+    'mited_rpc_client_requests_total', 'RPC calls made, by reply status ("timeout" or "error" when there was none).',
+    ('method', 'status')
+)
+
+http_latency = REGISTRY.histogram(
+    'mited_http_latency_seconds', 'Time spent handling an HTTP request.', ('method', 'route')
+)
+http_requests = REGISTRY.counter(
+    'mited_http_requests_total', 'HTTP responses sent, by status.', ('method', 'route', 'status')
+)
+http_response_size = REGISTRY.histogram(
+    'mited_http_response_bytes', 'Size of HTTP response bodies.', ('method', 'route'), SIZE_BUCKETS
+)
+http_in_flight = REGISTRY.gauge('mited_http_in_flight', 'HTTP requests being handled.', ('api',))
+
+notification_latency = REGISTRY.histogram(
+    'mited_notification_handler_latency_seconds', 'Time spent in notification handlers.', ('handler',)
+)
+notification_errors = REGISTRY.counter(
+    'mited_notification_handler_errors_total', 'Notification handlers that raised.', ('handler',)
+)
+notification_size = REGISTRY.histogram(
+    'mited_notification_bytes', 'Size of received notification messages.', ('handler',), SIZE_BUCKETS
+)
@@ -1,38 +1,25 @@
 import asyncio
 import json
-import requests
 import os
 import logging
+import signal
+import time
 
 from nats.aio.client import Client as NATS
 from sanic import Sanic, response
 
+from .. import codecs, loops, metrics, prefork, tracing
+from ..connections import ConnectionPool
+from ..executors import Executors
 from ..mixin.notifications import NotificationsMixin
 from ..service.errors import MiteDRPCError
 from ..service.client import RemoteService
 
+from .consul import ConsulClient, ConsulKeepAlive, KEEP_DEGRADED_SERVICE, TTL_TIMEOUT_INTERVAL
 from .methods import is_api_method
 from ..utils import get_members_if
 
 
-TTL_CHECK_IN_INTERVAL = os.getenv("TTL_CHECK_IN_INTERVAL", 15)
-# This is how often a service should pass it's TTL check
-
-TTL_TIMEOUT_INTERVAL = os.getenv("TTL_TIMEOUT_INTERVAL", "60s")
-# This determines how long the monitoring service waits before classifying a service as degraded
-# in the absence of a passing TTL check.
-
-CONSUL_ADDRESS = os.getenv("CONSUL_ADDRESS", "http://consul:8500")
-# This is routing to the consul cluster, in our case, handled by the consul k8 service.
-
-KEEP_DEGRADED_SERVICE = os.getenv("KEEP_DEGRADED_SERVICE", "3m")
-# Determines how long consul will keep a degraded service registered.
-
-RETRY_TTL_PASS_OR_REGISTRY = os.getenv("RETRY_TTL_PASS_OR_REGISTRY", 3)
-# Specifies how many times a service should try to pass TTL checks
-# OR REGISTER with Consul when receiving errors from http request.
-
-
 def api(
         name,
         versions,
@@ -40,62 +27,146 @@ def api(
         notification_topics=None,
         host='0.0.0.0',
         port=8000,
+        codec=codecs.DEFAULT_CODEC,
+        thread_pool_size=None,
+        process_pool_size=None,
+        compression=None,
+        topic_compression=None,
+        notification_batching=None,
+        streaming_cluster=None,
+        durable_topics=(),
+        connections=1,
+        loop_policy=None,
+        slow_callback_duration=None,
+        workers=None,
+        metrics_path='/metrics',
+        tracer=None,
+        untraced_topics=(),
 ):
+    """
+    The options shared with rpc_service work the same way here. `tracer` (a tracing.Tracer) records spans of the HTTP
+    requests served, continuing the trace of a W3C traceparent header, and of the calls and notifications made while
+    handling them. Notifications published within a sampled trace are prefixed with its context
+    (tracing.TRACE_MARKER), which consumers predating tracing can not decode: the notification topics in
+    `untraced_topics` are always published without it.
+    """
     def wrapper(cls):
 
         class Api(NotificationsMixin):
             _layer = 'middleware'
-            _loop = asyncio.get_event_loop()
+            _loop = None
             _name = name
             _broker_urls = broker_urls
             _notification_topics = notification_topics or []
-            _nc = NATS()
+            _nc = ConnectionPool(connections) if connections > 1 else NATS()
+            _codec = codecs.get_codec(codec)
+            _compression = codecs.Compression.get(compression)
+            _topic_compression = topic_compression or {}
+            _notification_batching = notification_batching or {}
+            _streaming_cluster = streaming_cluster
+            _durable_topics = tuple(durable_topics)
+            _untraced_topics = tuple(untraced_topics)
+            _workers = workers
 
             def __init__(self):
                 self._logger = logging.getLogger('mited.Middleware({})'.format(self._name))
+                self.executors = Executors(thread_pool_size, process_pool_size)
+                if tracer is not None:
+                    tracer.service = tracer.service or self._name
+                    tracing.set_tracer(tracer)
                 self._add_notify(cls)
-                self.registered_with_consul = False
-                self.consul_connection_attempts = RETRY_TTL_PASS_OR_REGISTRY
+                self._worker_index = 0
+                self._consul = ConsulKeepAlive(ConsulClient(), self._consul_registration(), logger=self._logger)
                 cls.loop = self._loop
+                cls.executors = self.executors
                 cls.get_remote_service = self.get_remote_service
                 cls.generate_endpoint_docs = self.generate_endpoint_docs
                 self.notification_handlers = self.get_notification_handlers(cls)
 
-            def start(self):
+            def start(self, workers=None):
+                """
+                With `workers` > 1 (passed here or to api(), or the MITED_WORKERS environment variable) the api forks
+                that many worker processes sharing the port through SO_REUSEPORT, each with its own loop and broker
+                connection. Only the first worker registers with consul.
+
+                Each worker keeps metrics of its own, labelled with its instance. A request to `metrics_path` is
+                answered by whichever worker accepts it; every worker answers requests on 'metrics.middleware.<name>'
+                over the broker, so collect them there (or scrape each worker separately) when running several.
+                """
                 self._load_app()
                 self._logger.info('\n'.join(['{} {}'.format(*(list(route.methods)[0], path))
                                  for path, route in self._app.router.routes_all.items()]))
 
+                workers = prefork.get_workers(workers or self._workers)
+                if workers > 1:
+                    return prefork.Prefork(self._start_worker, workers, self._logger).run()
+                self._new_loop()
                 self._loop.create_task(self._start())
                 self._loop.run_forever()
                 self._loop.close()
 
             def stop(self):
                 self._logger.info('Stopping...')
-                group = asyncio.gather(*asyncio.Task.all_tasks(), return_exceptions=True)
+                self._loop.run_until_complete(self._close_notifications())
+                self._loop.run_until_complete(self._consul.close())
+                if self._nc.is_connected:
+                    self._loop.run_until_complete(self._nc.close())
+                group = asyncio.gather(*asyncio.all_tasks(self._loop), return_exceptions=True)
                 group.cancel()
                 self._loop.run_until_complete(group)
                 self._loop.close()
-                self._deregister_with_consul()
+                self.executors.shutdown()
+                if tracer is not None:
+                    tracer.close()
+
+            def _new_loop(self):
+                self._loop = cls.loop = loops.new_event_loop(loop_policy, slow_callback_duration)
+
+            def _start_worker(self, index):
+                self._worker_index = index
+                self._new_loop()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    self._loop.add_signal_handler(sig, self._loop.stop)
+                self._logger = logging.getLogger('mited.Middleware({})[{}]'.format(self._name, index))
+                self._loop.create_task(self._start(sock=prefork.reuse_port_socket(host, port)))
+                self._loop.run_forever()
+                self.stop()
 
-            async def _start(self):
+            async def _start(self, sock=None):
                 self._logger.info('Connecting to %s', self._broker_urls)
-                await self._app.create_server(host=host, port=port)
+                if sock is None:
+                    await self._app.create_server(host=host, port=port)
+                else:
+                    await self._app.create_server(sock=sock)
                 await self._nc.connect(io_loop=self._loop, servers=self._broker_urls, verbose=True, name=self._name)
-                await self._pass_TTL_check()
+                if self._worker_index == 0:
+                    self._consul.start()
                 await self._start_notification_handlers()
+                await self._start_cache_invalidation(self._response_caches)
+                if metrics_path:
+                    await self._expose_metrics()
 
-            def get_remote_service(self, service_name, version):
+            def get_remote_service(self, service_name, version, codec=None, **options):
                 self._logger.debug('Remote service: %s %s', service_name, version)
-                return RemoteService(name=service_name, version=version, nc=self._nc)
+                return RemoteService(
+                    name=service_name, version=version, nc=self._nc, codec=codec or self._codec, **options
+                )
+
+            @property
+            def registered_with_consul(self):
+                return self._consul.registered
 
-            def _register_with_consul(self):
-                self.consul_id = os.getenv("HOSTNAME")
+            @property
+            def consul_id(self):
+                return self._consul.service_id
+
+            def _consul_registration(self):
+                consul_id = os.getenv("HOSTNAME")
                 # This is also the pod name
 
-                api_data = {
-                  "Name": self.consul_id,
-                  "ID": self.consul_id,
+                return {
+                  "Name": consul_id,
+                  "ID": consul_id,
                   "Address": f"api/{name}/{versions[0]}",
                   "Tags": [
                       "api",
@@ -103,49 +174,22 @@ def api(
                       name
                   ],
                   "Service": {
-                    "ID": self.consul_id,
+                    "ID": consul_id,
                     "Service": f"{name}-{versions[0]}"
                   },
                   "Check": {
-                      "CheckID": f"{self.consul_id}-TTLCheck",
+                      "CheckID": f"{consul_id}-TTLCheck",
                       "DeregisterCriticalServiceAfter": KEEP_DEGRADED_SERVICE,
                       "TTL": TTL_TIMEOUT_INTERVAL
                   }
                 }
 
-                try:
-                    r = requests.put(
-                        CONSUL_ADDRESS + "/v1/agent/service/register",
-                        data=json.dumps(api_data)
-                    )
-                except requests.exceptions.RequestException:
-                    self._logger.warning('Error whilst trying to register with consul', exc_info=True)
-                    self.consul_connection_attempts -= 1
-                else:
-                    if r.ok:
-                        self.registered_with_consul = True
-                        # Reset this now that we have registered with consul
-                        # so that we have `RETRY_TTL_PASS_OR_REGISTRY` times attempts for
-                        # purely the TTL ping as well
-                        self.consul_connection_attempts = RETRY_TTL_PASS_OR_REGISTRY
-
-            def _deregister_with_consul(self):
-                requests.put(CONSUL_ADDRESS + f"/v1/agent/service/deregister/{self.consul_id}")
-
-            async def _pass_TTL_check(self):
-                while True and self.consul_connection_attempts:
-                    try:
-                        if self.registered_with_consul:
-                            requests.put(f"{CONSUL_ADDRESS}/v1/agent/check/pass/{self.consul_id}-TTLCheck")
-                        else:
-                            self._register_with_consul()
-                        await asyncio.sleep(TTL_CHECK_IN_INTERVAL)
-                    except requests.exceptions.RequestException:
-                        self.consul_connection_attempts -= 1
-
             def _load_app(self):
                 self.endpoints = {'*': {}}
+                self._response_caches = []
                 self._app = Sanic(name=name)
+                if metrics_path:
+                    self._app.add_route(self._render_metrics, metrics_path, methods=['GET'])
                 self.parse_wrapped_endpoints()
                 for version in versions:
                     for path, methods in self.endpoints.get('*', {}).items():
@@ -158,18 +202,59 @@ def api(
             def parse_wrapped_endpoints(self):
                 wrapped = cls()
                 for member in get_members_if(is_api_method, wrapped):
+                        if hasattr(member, '__response_cache__'):
+                            self._response_caches.append(member.__response_cache__)
                         for api_version in member.__api_versions__:
                             version = self.endpoints.get(api_version, {})
                             path = version.get(member.__api_path__, {})
-                            path[member.__api_method__] = self._type_response(member)
+                            path[member.__api_method__] = self._type_response(member, self._name)
                             version[member.__api_path__] = path
                             self.endpoints[api_version] = version
 
             @staticmethod
-            def _type_response(method):
-                response_type = method.__response_type__ if hasattr(method, '__response_type__') else response.json
+            async def _render_metrics(request):
+                text = metrics.REGISTRY.render((('instance', metrics.get_instance()),))
+                return response.text(text, content_type=metrics.CONTENT_TYPE)
 
-                async def typed_handler(*args, **kwargs):
+            async def _expose_metrics(self):
+                subject = metrics.get_metrics_subject(self._layer, self._name)
+                self._logger.info("Exposing metrics on subject: '%s'", subject)
+                await self._nc.subscribe(subject, cb=self._reply_metrics)
+
+            async def _reply_metrics(self, request):
+                await self._nc.publish(request.reply, codecs.encode(metrics.render_reply(), self._codec))
+
+            @staticmethod
+            def _type_response(method, api_name=''):
+                response_type = method.__response_type__ if hasattr(method, '__response_type__') else response.json
+                http_method, route = method.__api_method__, method.__api_path__
+                in_flight = metrics.http_in_flight.labels(api_name)
+
+                async def typed_handler(request, *args, **kwargs):
+                    started = time.perf_counter()
+                    in_flight.inc()
+                    context = tracing.parse_traceparent(request.headers.get('traceparent'))
+                    span = tracing.start_span('{} {}'.format(http_method, route), context)
+                    status = 500
+                    try:
+                        result = await handle(request, *args, **kwargs)
+                        status = getattr(result, 'status', None)
+                        if status is None and isinstance(result, tuple):
+                            status = result[1][0]
+                    except Exception as err:
+                        status = getattr(err, 'status_code', 500)
+                        raise
+                    finally:
+                        in_flight.dec()
+                        metrics.http_latency.labels(http_method, route).observe(time.perf_counter() - started)
+                        metrics.http_requests.labels(http_method, route, status).inc()
+                        tracing.finish_span(span, status=status, path=request.path)
+                    body = getattr(result, 'body', None)
+                    if body is not None:
+                        metrics.http_response_size.labels(http_method, route).observe(len(body))
+                    return result
+
+                async def call_handler(*args, **kwargs):
                     result = method(*args, **kwargs)
                     try:
                         result = (await result) if asyncio.iscoroutine(result) else result
@@ -183,6 +268,10 @@ def api(
                         return response_type(*(body, *rest))
                     except MiteDRPCError as err:
                         return err.message, (err.status,)
+
+                # Inside the instrumentation, so cache hits and 304s are measured and traced like other responses.
+                cache = getattr(method, '__response_cache__', None)
+                handle = cache.wrap(call_handler) if cache is not None else call_handler
                 return typed_handler
 
             def generate_endpoint_docs(self):
@@ -0,0 +1,102 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+from sanic.response import HTTPResponse
+
+
+def cached(ttl, max_size=256, vary=(), invalidate_on=()):
+    """
+    Caches the responses of a GET endpoint for `ttl` seconds, keyed by path, query string and the request headers
+    listed in `vary`; at most `max_size` responses are kept (LRU). Responses carry an ETag and a request whose
+    If-None-Match matches it gets a 304 without a body.
+
+    `invalidate_on` lists notification subjects (e.g. 'notification.service.runs.updated', wildcards allowed) that clear
+    the cache when a notification arrives. Every api process subscribes to them, each one holds its own cache.
+    """
+    def wrapper(fn):
+        fn.__response_cache__ = ResponseCache(ttl, max_size, vary, invalidate_on)
+        return fn
+    return wrapper
+
+
+def make_etag(body):
+    return '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or 'W/' + etag in candidates
+
+
+class ResponseCache:
+    def __init__(self, ttl, max_size=256, vary=(), invalidate_on=()):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._vary = tuple(vary)
+        self.invalidate_on = tuple(invalidate_on)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, request):
+        return (request.path, request.query_string) + tuple(request.headers.get(header) for header in self._vary)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        entry = (
+            time.monotonic() + self._ttl, make_etag(result.body), result.body, result.status,
+            dict(result.headers), result.content_type,
+        )
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'not_modified': self.not_modified,
+        }
+
+    def wrap(self, handler):
+        async def cached_handler(request, *args, **kwargs):
+            if request.method != 'GET':
+                return await handler(request, *args, **kwargs)
+            key = self.make_key(request)
+            entry = self.get(key)
+            if entry is None:
+                result = await handler(request, *args, **kwargs)
+                if not isinstance(result, HTTPResponse) or result.status != 200:
+                    return result
+                entry = self.put(key, result)
+            _, etag, body, status, headers, content_type = entry
+            if etag_matches(request.headers.get('If-None-Match'), etag):
+                self.not_modified += 1
+                return HTTPResponse(status=304, headers={'ETag': etag})
+            return HTTPResponse(
+                status=status, headers=dict(headers, ETag=etag), content_type=content_type, body_bytes=body
+            )
+        return cached_handler
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+TTL_CHECK_IN_INTERVAL = float(os.getenv("TTL_CHECK_IN_INTERVAL", 15))
+# This is how often a service should pass it's TTL check
+
+TTL_TIMEOUT_INTERVAL = os.getenv("TTL_TIMEOUT_INTERVAL", "60s")
+# This determines how long the monitoring service waits before classifying a service as degraded
+# in the absence of a passing TTL check.
+
+CONSUL_ADDRESS = os.getenv("CONSUL_ADDRESS", "http://consul:8500")
+# This is routing to the consul cluster, in our case, handled by the consul k8 service.
+
+KEEP_DEGRADED_SERVICE = os.getenv("KEEP_DEGRADED_SERVICE", "3m")
+# Determines how long consul will keep a degraded service registered.
+
+RETRY_TTL_PASS_OR_REGISTRY = int(os.getenv("RETRY_TTL_PASS_OR_REGISTRY", 3))
+# Specifies how many times a service should try to pass TTL checks
+# OR REGISTER with Consul when receiving errors from http request.
+
+CONSUL_TIMEOUT = float(os.getenv("CONSUL_TIMEOUT", 5))
+# Connect and read timeout of a single request to consul, in seconds.
+
+CONSUL_RETRY_BACKOFF = float(os.getenv("CONSUL_RETRY_BACKOFF", 1))
+# Base of the exponential backoff between retries, each wait is drawn at random up to base * 2 ** attempt.
+
+
+class ConsulError(Exception):
+    def __init__(self, status, message=''):
+        super().__init__('consul answered {} {}'.format(status, message))
+        self.status = status
+
+
+class ConsulClient:
+    """
+    Talks to the consul agent without blocking the event loop: requests go through a keep-alive requests.Session on a
+    thread of its own, so a slow agent only delays the heartbeat, never the requests being served.
+    """
+    def __init__(self, address=CONSUL_ADDRESS, timeout=CONSUL_TIMEOUT):
+        self._address = address.rstrip('/')
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mited-consul')
+
+    async def put(self, path, data=None):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._put, path, data)
+
+    def _put(self, path, data):
+        r = self._session.put(
+            self._address + path,
+            data=None if data is None else json.dumps(data),
+            timeout=self._timeout,
+        )
+        if not r.ok:
+            raise ConsulError(r.status_code, r.text)
+        return r
+
+    async def register(self, registration):
+        await self.put('/v1/agent/service/register', registration)
+
+    async def deregister(self, service_id):
+        await self.put(f'/v1/agent/service/deregister/{service_id}')
+
+    async def pass_check(self, check_id):
+        await self.put(f'/v1/agent/check/pass/{check_id}')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+
+class ConsulKeepAlive:
+    """
+    Registers a service and passes its TTL check every `interval` seconds. Failed calls are retried up to `retries`
+    times with jittered exponential backoff; when consul no longer knows the check (it deregistered the service after
+    it stayed critical for too long) the service registers again.
+    """
+    def __init__(self, client, registration, interval=TTL_CHECK_IN_INTERVAL, retries=RETRY_TTL_PASS_OR_REGISTRY,
+                 backoff=CONSUL_RETRY_BACKOFF, logger=None):
+        self._client = client
+        self._registration = registration
+        self._interval = interval
+        self._retries = retries
+        self._backoff = backoff
+        self._logger = logger or logging.getLogger('mited.Consul')
+        self.registered = False
+        self.failures = 0
+        self._task = None
+
+    @property
+    def service_id(self):
+        return self._registration['ID']
+
+    @property
+    def check_id(self):
+        return self._registration['Check']['CheckID']
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        """
+        Stops the heartbeat and deregisters the service.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.deregister()
+        self._client.close()
+
+    async def run(self):
+        while True:
+            await self._with_retries(self._check_in)
+            await asyncio.sleep(self._interval)
+
+    async def deregister(self, timeout=CONSUL_TIMEOUT):
+        if not self.registered:
+            return
+        try:
+            await asyncio.wait_for(self._client.deregister(self.service_id), timeout)
+            self.registered = False
+        except (asyncio.TimeoutError, requests.exceptions.RequestException, ConsulError):
+            self._logger.warning('Error whilst trying to deregister from consul', exc_info=True)
+
+    async def _check_in(self):
+        if not self.registered:
+            await self._client.register(self._registration)
+            self.registered = True
+            self._logger.info('Registered with consul as %s', self.service_id)
+        try:
+            await self._client.pass_check(self.check_id)
+        except ConsulError as err:
+            if err.status == 404:
+                self.registered = False
+            raise
+
+    async def _with_retries(self, call):
+        for attempt in range(self._retries):
+            try:
+                return await call()
+            except (requests.exceptions.RequestException, ConsulError):
+                self.failures += 1
+                self._logger.warning('Error whilst trying to check in with consul', exc_info=True)
+                if attempt + 1 < self._retries:
+                    await asyncio.sleep(random.uniform(0, self._backoff * 2 ** attempt))
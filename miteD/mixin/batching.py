@@ -0,0 +1,123 @@
+import asyncio
+import logging
+
+from .. import codecs, tracing
+
+
+BATCH_MARKER = b'\x03'
+# A notification payload starting with this byte carries a list of notifications, encoded together (no codec,
+# compression or chunk marker starts with it).
+
+DEFAULT_BATCH_WAIT = 0.05
+# Longest a buffered notification waits for its batch to fill up, in seconds.
+
+
+class Batching:
+    """
+    Publisher side batching of a notification topic: notifications are buffered and published together as one message
+    once `size` of them are waiting or the oldest one has waited `max_wait` seconds. Consumers must run a miteD version
+    that understands batches.
+    """
+    def __init__(self, size=100, max_wait=DEFAULT_BATCH_WAIT):
+        self.size = size
+        self.max_wait = max_wait
+
+    @classmethod
+    def get(cls, setting):
+        if setting is None or isinstance(setting, cls):
+            return setting
+        return cls(size=setting)
+
+
+def pack(items, codec=None, compression=None):
+    return BATCH_MARKER + codecs.encode(items, codec, compression)
+
+
+def unpack(data):
+    """
+    Returns the notifications carried by a payload, batched or not.
+    """
+    if data[:1] == BATCH_MARKER:
+        _, items = codecs.decode(data[1:])
+        return items
+    _, item = codecs.decode(data)
+    return [item]
+
+
+class _Buffer:
+    def __init__(self, size, max_wait, name=''):
+        self._size = size
+        self._max_wait = max_wait
+        self._items = []
+        self._timer = None
+        self._logger = logging.getLogger('mited.{}({})'.format(type(self).__name__, name))
+
+    def __len__(self):
+        return len(self._items)
+
+    async def add(self, *items):
+        self._items.extend(items)
+        if len(self._items) >= self._size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self._max_wait, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        asyncio.ensure_future(self._flush_on_timer())
+
+    async def _flush_on_timer(self):
+        # Nobody awaits this flush, errors would otherwise only surface as an unretrieved task exception.
+        count = len(self._items)
+        try:
+            await self.flush()
+        except Exception:
+            self._logger.exception('Error delivering a batch of %s notifications', count)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        for start in range(0, len(items), self._size):
+            await self._deliver(items[start:start + self._size])
+
+    async def _deliver(self, items):
+        raise NotImplementedError
+
+
+class PublishBuffer(_Buffer):
+    """
+    Buffers the notifications published on one subject, see Batching. Unless `traced` is False, a batch carries the
+    trace context of the first of its notifications published within a sampled trace.
+    """
+    def __init__(self, nc, subject, batching, codec=None, compression=None, traced=True):
+        super().__init__(batching.size, batching.max_wait, subject)
+        self._nc = nc
+        self._subject = subject
+        self._codec = codec
+        self._compression = compression
+        self._traced = traced
+
+    async def publish(self, msg):
+        await self.add((msg, tracing.current_span.get() if self._traced else None))
+
+    async def _deliver(self, items):
+        span = next((span for _, span in items if span is not None and span is not tracing.NOT_SAMPLED), None)
+        payload = pack([msg for msg, _ in items], self._codec, self._compression)
+        if span is not None:
+            payload = tracing.wrap_notification(payload, span)
+        await self._nc.publish(self._subject, payload)
+
+
+class HandlerBatch(_Buffer):
+    """
+    Collects the notifications for a handler declared with `batch_size` and calls it with lists of (subject, data)
+    pairs, `batch_size` at most, once enough of them arrived or the oldest one waited `max_wait` seconds.
+    """
+    def __init__(self, call, batch_size, max_wait, name=''):
+        super().__init__(batch_size, max_wait, name)
+        self._call = call
+
+    async def _deliver(self, items):
+        await self._call(items)
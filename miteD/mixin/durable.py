@@ -0,0 +1,85 @@
+import logging
+import uuid
+from datetime import datetime
+
+from nats.aio.client import Msg
+
+try:
+    from stan.aio.client import Client as STAN
+except ImportError:  # pragma: no cover - optional dependency
+    STAN = None
+
+
+DEFAULT_MAX_INFLIGHT = 64
+# Unacknowledged notifications the streaming server may have out to one durable handler.
+
+DEFAULT_ACK_WAIT = 30
+# Seconds the streaming server waits for an acknowledgement before delivering a notification again.
+
+
+def get_start_options(start_sequence=None, start_time=None, deliver_all=False):
+    """
+    Where a durable subscription starts the first time it is created; once it exists it resumes after the last
+    acknowledged notification and these are ignored.
+    """
+    if start_sequence is not None:
+        return {'start_at': 'sequence', 'sequence': start_sequence}
+    if start_time is not None:
+        if isinstance(start_time, datetime):
+            start_time = start_time.timestamp()
+        return {'start_at': 'time', 'time': start_time}
+    if deliver_all:
+        return {'deliver_all_available': True}
+    return {}
+
+
+class Streaming:
+    """
+    NATS Streaming connection of a service or api, layered on its broker connection. Notifications published through
+    it are persisted by the streaming server, durable handlers get them through durable queue subscriptions and
+    acknowledge each one after the handler returned, so notifications missed while a consumer was down or failed in
+    its handler are delivered again.
+    """
+    def __init__(self, cluster_id, logger=None):
+        if STAN is None:
+            raise RuntimeError('durable notifications need the asyncio-nats-streaming package')
+        self._cluster_id = cluster_id
+        self._sc = STAN()
+        self._logger = logger or logging.getLogger('mited.Streaming')
+
+    async def connect(self, nc, name):
+        # The client id has to be unique on the streaming server, replicas share the service name.
+        client_id = '{}-{}'.format(name, uuid.uuid4().hex[:12]).replace('.', '_')
+        await self._sc.connect(self._cluster_id, client_id, nats=nc)
+
+    async def publish(self, subject, payload):
+        """
+        Returns once the streaming server has persisted the notification.
+        """
+        await self._sc.publish(subject, payload)
+
+    async def subscribe(self, subject, queue, durable_name, handler, options):
+        async def on_msg(msg):
+            try:
+                await handler(Msg(subject=subject, data=msg.proto.data))
+            except Exception:
+                self._logger.exception(
+                    'Durable handler %s failed on %s #%s, it is delivered again',
+                    durable_name, subject, msg.proto.sequence,
+                )
+                return
+            await self._sc.ack(msg)
+
+        return await self._sc.subscribe(
+            subject,
+            queue=queue,
+            durable_name=durable_name,
+            cb=on_msg,
+            manual_acks=True,
+            max_inflight=options['max_inflight'],
+            ack_wait=options['ack_wait'],
+            **options['start'],
+        )
+
+    async def close(self):
+        await self._sc.close()
@@ -1,7 +1,11 @@
 import asyncio
-import json
+import time
 from functools import wraps, partial
 
+from .. import codecs, metrics, tracing
+from . import batching, durable
+from .partitions import PartitionedWorkers, DEFAULT_MAX_QUEUED
+from ..executors import set_executor, get_executor
 from ..utils import get_members_if
 
 
@@ -9,21 +13,94 @@ def is_notification_handler(method):
     return getattr(method, '__is_notification_handler__', False)
 
 
-def notification_handler(layer='*', producer='*', topic='*'):
+def notification_handler(layer='*', producer='*', topic='*', executor=None, batch_size=None,
+                         max_wait=batching.DEFAULT_BATCH_WAIT, concurrency=None, partition_key=None,
+                         max_queued=DEFAULT_MAX_QUEUED, durable_name=None, max_inflight=durable.DEFAULT_MAX_INFLIGHT,
+                         ack_wait=durable.DEFAULT_ACK_WAIT, start_sequence=None, start_time=None, deliver_all=False):
+    """
+    With `batch_size` the handler is called with lists of up to that many (subject, data) pairs instead of once per
+    notification, a list is delivered early once its first notification waited `max_wait` seconds.
+
+    With `concurrency` the notifications are handled by that many workers instead of inside the subscription callback,
+    those sharing a `partition_key` (a payload field name or a function of the payload) in order, see
+    partitions.PartitionedWorkers.
+
+    With `durable_name` the handler subscribes through NATS Streaming (the service needs a `streaming_cluster`), see
+    durable.Streaming: a notification is acknowledged once the handler returned and delivered again otherwise, at most
+    `max_inflight` unacknowledged ones at a time. `start_sequence`, `start_time` or `deliver_all` replay the stored
+    notifications the first time the durable subscription is created.
+    """
+    if batch_size and concurrency:
+        raise ValueError('batch_size and concurrency cannot be combined')
+    if durable_name and (batch_size or concurrency):
+        raise ValueError('durable handlers are acknowledged per notification, batch_size and concurrency do not apply')
+    if durable_name and '*' in (layer, producer, topic):
+        raise ValueError('durable handlers need a concrete subject, NATS Streaming has no wildcards')
+
     def wrapper(fn):
         fn.__is_notification_handler__ = True
         fn.__notification_layer__ = layer
         fn.__notification_producer__ = producer
         fn.__notification_topic__ = topic
+        fn.__notification_durable__ = {
+            'durable_name': durable_name,
+            'max_inflight': max_inflight,
+            'ack_wait': ack_wait,
+            'start': durable.get_start_options(start_sequence, start_time, deliver_all),
+        } if durable_name else None
+        set_executor(fn, executor)
 
-        @wraps(fn)
-        async def translate(self, msg):
-            subject = msg.subject
-            data = json.loads(msg.data.decode())
-            if asyncio.iscoroutinefunction(fn):
-                return await fn(self, subject, data)
-            else:
-                return fn(self, subject, data)
+        async def call(self, *args):
+            started = time.perf_counter()
+            try:
+                if get_executor(fn):
+                    return await self.executors.call(fn, self, *args)
+                elif asyncio.iscoroutinefunction(fn):
+                    return await fn(self, *args)
+                else:
+                    return fn(self, *args)
+            except Exception:
+                metrics.notification_errors.labels(fn.__qualname__).inc()
+                raise
+            finally:
+                metrics.notification_latency.labels(fn.__qualname__).observe(time.perf_counter() - started)
+
+        if batch_size:
+            @wraps(fn)
+            async def translate(self, msg):
+                metrics.notification_size.labels(fn.__qualname__).observe(len(msg.data))
+                batch = self._handler_batches.get(translate)
+                if batch is None:
+                    batch = batching.HandlerBatch(partial(call, self), batch_size, max_wait, name=fn.__name__)
+                    self._handler_batches[translate] = batch
+                _, payload = tracing.unwrap_notification(msg.data)
+                await batch.add(*[(msg.subject, data) for data in batching.unpack(payload)])
+        elif concurrency:
+            @wraps(fn)
+            async def translate(self, msg):
+                metrics.notification_size.labels(fn.__qualname__).observe(len(msg.data))
+                workers = self._handler_workers.get(translate)
+                if workers is None:
+                    workers = PartitionedWorkers(
+                        partial(call, self), concurrency, partition_key, max_queued, name=fn.__name__
+                    )
+                    self._handler_workers[translate] = workers
+                _, payload = tracing.unwrap_notification(msg.data)
+                for data in batching.unpack(payload):
+                    await workers.put(msg.subject, data)
+        else:
+            @wraps(fn)
+            async def translate(self, msg):
+                metrics.notification_size.labels(fn.__qualname__).observe(len(msg.data))
+                subject = msg.subject
+                context, payload = tracing.unwrap_notification(msg.data)
+                # Only notifications published within a sampled trace are traced.
+                span = tracing.start_span(fn.__qualname__, context) if context else None
+                try:
+                    for data in batching.unpack(payload):
+                        await call(self, subject, data)
+                finally:
+                    tracing.finish_span(span, subject=subject)
 
         return translate
     return wrapper
@@ -33,16 +110,49 @@ class Notify():
     pass
 
 class NotificationsMixin(object):
+    _compression = None
+    _topic_compression = {}
+    _notification_batching = {}
+    _streaming_cluster = None
+    _durable_topics = ()
+    _untraced_topics = ()
+
     async def _start_notification_handlers(self):
+        if self._streaming is not None:
+            await self._streaming.connect(getattr(self._nc, 'connections', [self._nc])[0], self._name)
         coros = []
         for h in self.notification_handlers:
             subject, queue = self._get_notification_subject_and_queue(h)
             self._logger.info("Starting notifications handler '{}' for subject/queue: '{}'/'{}'".format(
                 h.__name__, subject, queue
             ))
-            coros.append(self._nc.subscribe(subject, queue=queue, cb=h))
+            options = h.__notification_durable__
+            if options is None:
+                coros.append(self._nc.subscribe(subject, queue=queue, cb=h))
+            elif self._streaming is None:
+                raise RuntimeError('durable handler {} needs a streaming_cluster'.format(h.__name__))
+            else:
+                coros.append(self._streaming.subscribe(subject, queue, options['durable_name'], h, options))
         await asyncio.gather(*coros)
 
+    async def _start_cache_invalidation(self, caches):
+        """
+        Clears each cache whenever a notification arrives on one of its `invalidate_on` subjects. These subscriptions
+        join no queue group, every process has to drop its own copy.
+        """
+        subjects = {}
+        for cache in caches:
+            for subject in cache.invalidate_on:
+                subjects.setdefault(subject, []).append(cache)
+        for subject, subject_caches in subjects.items():
+            self._logger.info("Invalidating {} response cache(s) on subject: '{}'".format(len(subject_caches), subject))
+            await self._nc.subscribe(subject, cb=partial(self._invalidate_caches, subject_caches))
+
+    @staticmethod
+    async def _invalidate_caches(caches, msg):
+        for cache in caches:
+            cache.invalidate()
+
     def get_notification_handlers(self, cls):
         wrapped = cls()
         return get_members_if(is_notification_handler, wrapped)
@@ -60,15 +170,64 @@ class NotificationsMixin(object):
         return subject, queue
 
     async def _send_notification(self, subject, msg):
-        await self._nc.publish(subject, json.dumps(msg).encode())
+        compression = self._notification_compression.get(subject)
+        publisher = self._streaming if subject in self._durable_subjects else self._nc
+        payload = codecs.encode(msg, self._codec, compression)
+        if subject in self._traced_subjects:
+            payload = tracing.wrap_notification(payload)
+        await publisher.publish(subject, payload)
+
+    async def _flush_notifications(self):
+        """
+        Publishes the buffered notifications and hands the collected ones to their batch handlers.
+        """
+        buffers = list(self._publish_buffers.values()) + list(self._handler_batches.values())
+        await asyncio.gather(*[buffer.flush() for buffer in buffers])
+        await asyncio.gather(*[workers.join() for workers in self._handler_workers.values()])
+
+    async def _close_notifications(self):
+        await self._flush_notifications()
+        if self._streaming is not None:
+            await self._streaming.close()
+
+    def get_notification_worker_stats(self):
+        """
+        Queue depths and counters of the handlers declared with `concurrency`, by handler name.
+        """
+        return {handler.__name__: workers.stats() for handler, workers in self._handler_workers.items()}
 
     def _add_notify(self, cls):
+        self._notification_compression = {}
+        self._publish_buffers = {}
+        self._handler_batches = cls._handler_batches = {}
+        self._handler_workers = cls._handler_workers = {}
+        self._durable_subjects = set()
+        self._traced_subjects = set()
+        self._streaming = durable.Streaming(self._streaming_cluster, self._logger) if self._streaming_cluster else None
         if not self._notification_topics:
             return
         notify = Notify()
         for topic, subject in self._get_notification_topic_and_subject_pairs():
             self._logger.info("Registering notifications topic/subject: '{}'/'{}'".format(topic, subject))
-            setattr(notify, topic, partial(self._send_notification, subject))
+            compression = self._topic_compression.get(topic, self._compression)
+            self._notification_compression[subject] = codecs.Compression.get(compression)
+            if topic in self._durable_topics:
+                if self._streaming is None:
+                    raise RuntimeError('durable topic {} needs a streaming_cluster'.format(topic))
+                self._durable_subjects.add(subject)
+            if topic not in self._untraced_topics:
+                self._traced_subjects.add(subject)
+            topic_batching = batching.Batching.get(self._notification_batching.get(topic))
+            if topic_batching is None:
+                setattr(notify, topic, partial(self._send_notification, subject))
+            else:
+                buffer = batching.PublishBuffer(
+                    self._streaming if subject in self._durable_subjects else self._nc,
+                    subject, topic_batching, self._codec, self._notification_compression[subject],
+                    traced=subject in self._traced_subjects,
+                )
+                self._publish_buffers[subject] = buffer
+                setattr(notify, topic, buffer.publish)
         cls.notify = notify
 
     def _get_notification_topic_and_subject_pairs(self):
@@ -0,0 +1,82 @@
+import asyncio
+import itertools
+import logging
+from zlib import crc32
+
+
+DEFAULT_MAX_QUEUED = 100
+# Notifications a partition worker may have waiting before the subscription stops taking new ones.
+
+
+def get_partition_key(partition_key, data):
+    if partition_key is None:
+        return None
+    if callable(partition_key):
+        return partition_key(data)
+    return data.get(partition_key) if isinstance(data, dict) else None
+
+
+class PartitionedWorkers:
+    """
+    Runs a notification handler on `concurrency` workers, each with a queue of its own. Notifications with the same
+    partition key (a payload field name or a function of the payload) always go to the same worker, so they are handled
+    in order; notifications without one are spread round robin. When a worker has `max_queued` notifications waiting
+    the subscription callback waits for room, so further notifications pile up in the subscription's pending queue
+    (where the client drops them as a slow consumer once it is full).
+    """
+    def __init__(self, call, concurrency, partition_key=None, max_queued=DEFAULT_MAX_QUEUED, name=''):
+        self._call = call
+        self._concurrency = concurrency
+        self._partition_key = partition_key
+        self._max_queued = max_queued
+        self._logger = logging.getLogger('mited.PartitionedWorkers({})'.format(name))
+        self._queues = []
+        self._workers = []
+        self._round_robin = itertools.count()
+        self.processed = 0
+        self.errors = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+    def _start(self):
+        self._queues = [asyncio.Queue(maxsize=self._max_queued) for _ in range(self._concurrency)]
+        self._workers = [asyncio.ensure_future(self._work(queue)) for queue in self._queues]
+
+    def get_partition(self, data):
+        key = get_partition_key(self._partition_key, data)
+        if key is None:
+            return next(self._round_robin) % self._concurrency
+        return crc32(str(key).encode()) % self._concurrency
+
+    async def put(self, subject, data):
+        if not self._workers:
+            self._start()
+        queue = self._queues[self.get_partition(data)]
+        if queue.full():
+            self.blocked += 1
+        await queue.put((subject, data))
+        self.max_depth = max(self.max_depth, queue.qsize())
+
+    async def _work(self, queue):
+        while True:
+            subject, data = await queue.get()
+            try:
+                await self._call(subject, data)
+                self.processed += 1
+            except Exception:
+                self.errors += 1
+                self._logger.exception('Error handling notification on %s', subject)
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        await asyncio.gather(*[queue.join() for queue in self._queues])
+
+    def stats(self):
+        return {
+            'depths': [queue.qsize() for queue in self._queues],
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+            'blocked': self.blocked,
+        }
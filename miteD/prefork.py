@@ -0,0 +1,113 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+
+WORKERS_ENV = 'MITED_WORKERS'
+# Environment variable setting the number of worker processes when start() is not given one.
+
+RESTART_DELAY = float(os.getenv('MITED_WORKER_RESTART_DELAY', 1.0))
+# Pause before restarting a worker that died shortly after it was started, so a crashing worker does not spin.
+
+
+def get_workers(workers=None):
+    return int(workers or os.getenv(WORKERS_ENV) or 1)
+
+
+def reuse_port_socket(host, port):
+    """
+    A socket bound with SO_REUSEPORT, so every worker can listen on the same port and the kernel spreads the incoming
+    connections over them.
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+class ProcessThread:
+    """
+    A daemon thread running `target`, started per process: threads do not survive fork, so a prefork worker starts one
+    of its own rather than counting on one started before it was forked. `running` tells whether this process has it.
+    """
+    def __init__(self, target, name):
+        self._target = target
+        self._name = name
+        self._thread = None
+        self._pid = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid()
+
+    def start(self):
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._target, name=self._name, daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+        self._thread = None
+        self._pid = None
+
+
+class Prefork:
+    """
+    Forks `workers` processes running `target(index)` and supervises them: crashed workers are restarted, SIGINT and
+    SIGTERM are forwarded to the workers and the supervisor returns once all of them have exited.
+    """
+    def __init__(self, target, workers, logger=None, restart_delay=RESTART_DELAY):
+        self._target = target
+        self._workers = workers
+        self._logger = logger or logging.getLogger('mited.Prefork')
+        self._restart_delay = restart_delay
+        self._children = {}
+        self._stopping = False
+
+    def run(self):
+        previous = {sig: signal.signal(sig, self._forward) for sig in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            for index in range(self._workers):
+                self._spawn(index)
+            while self._children:
+                pid, status = os.wait()
+                index, started = self._children.pop(pid, (None, None))
+                if index is None or self._stopping:
+                    continue
+                self._logger.warning('Worker %s (pid %s) exited with status %s, restarting', index, pid, status)
+                if time.monotonic() - started < self._restart_delay:
+                    time.sleep(self._restart_delay)
+                if not self._stopping:
+                    self._spawn(index)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self._target(index)
+            except BaseException:
+                self._logger.exception('Worker %s crashed', index)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self._logger.info('Started worker %s (pid %s)', index, pid)
+        self._children[pid] = (index, time.monotonic())
+
+    def _forward(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
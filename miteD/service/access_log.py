@@ -0,0 +1,93 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from ..prefork import ProcessThread
+
+
+DEFAULT_CAPACITY = 10000
+# Records waiting to be written before new ones are dropped.
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+# Seconds between two batches written by the writer thread.
+
+_FORMAT = '[%s]"%s" %s %s'
+
+
+class AccessLog:
+    """
+    Access log of the RPC replies a service sends. Recording a reply only appends a (time, subject, status, length)
+    tuple to a ring buffer of up to `capacity` records; a thread of its own formats them and hands them to `logger`
+    ('mited.rpc.access') in batches, every `flush_interval` seconds, so slow log handlers never block the loop. When the
+    buffer is full new records are dropped and counted in `dropped`.
+
+    A reply is recorded with probability `sample_rate`, or the rate `status_sample_rates` maps its status to, e.g.
+    sample_rate=0.01, status_sample_rates={500: 1, 504: 1} keeps every failure and 1% of the rest, and a rate of 0
+    filters a status out. The log records carry the subject, status and length as attributes for structured formatters.
+    """
+    def __init__(
+            self,
+            logger=None,
+            sample_rate=1.0,
+            status_sample_rates=None,
+            capacity=DEFAULT_CAPACITY,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+    ):
+        self._logger = logger or logging.getLogger('mited.rpc.access')
+        self._sample_rate = sample_rate
+        self._status_sample_rates = status_sample_rates or {}
+        self._capacity = capacity
+        self._flush_interval = flush_interval
+        self._records = deque()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._writer = ProcessThread(self._write, 'mited-access-log')
+        self.recorded = 0
+        self.dropped = 0
+
+    def record(self, subject, status, length):
+        rate = self._status_sample_rates.get(status, self._sample_rate)
+        if rate < 1 and random.random() >= rate:
+            return
+        if not self._logger.isEnabledFor(logging.INFO):
+            return
+        if not self._writer.running:
+            # Records buffered before a fork belong to the parent.
+            self._closing = False
+            self._wakeup.clear()
+            self._records.clear()
+            self._writer.start()
+        if len(self._records) >= self._capacity:
+            self.dropped += 1
+            return
+        self._records.append((time.time(), subject, status, length))
+        self.recorded += 1
+
+    def close(self):
+        """
+        Writes the records still buffered and stops the writer thread.
+        """
+        if self._writer.running:
+            self._closing = True
+            self._wakeup.set()
+            self._writer.join()
+
+    def _write(self):
+        while True:
+            self._wakeup.wait(self._flush_interval)
+            closing = self._closing
+            self._flush()
+            if closing:
+                return
+
+    def _flush(self):
+        records = self._records
+        for _ in range(len(records)):
+            timestamp, subject, status, length = records.popleft()
+            self._logger.info(
+                _FORMAT, datetime.utcfromtimestamp(timestamp).isoformat(), subject, status, length,
+                extra={'subject': subject, 'status': status, 'length': length},
+            )
@@ -0,0 +1,72 @@
+import json
+import time
+from collections import OrderedDict
+
+from ..utils import CustomJsonEncoder
+
+
+_key_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=CustomJsonEncoder().default)
+
+
+def make_call_key(method_path, args):
+    """
+    Identifies a call by method path and canonical JSON of its arguments, or returns None if they can't be encoded.
+    """
+    try:
+        return method_path, _key_encoder.encode(args)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultCache:
+    """
+    Size bounded LRU cache of RPC results for RemoteService.
+
+    The TTL of a result is taken from `method_ttls` (keyed by method name), then from the `cache_ttl` the service
+    advertises in its reply (see `rpc_method(cache_ttl=...)`), then from `ttl`. Results without a TTL are not cached.
+    Cached values are shared between callers and must not be mutated.
+    """
+    def __init__(self, max_size=1024, ttl=None, method_ttls=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._method_ttls = method_ttls or {}
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, advertised_ttl=None):
+        method_name = key[0].rsplit('.', 1)[-1]
+        ttl = self._method_ttls.get(method_name, advertised_ttl if advertised_ttl is not None else self._ttl)
+        if not ttl:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, method_path=None):
+        if method_path is None:
+            self._entries.clear()
+        else:
+            for key in [key for key in self._entries if key[0] == method_path]:
+                del self._entries[key]
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
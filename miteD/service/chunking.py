@@ -0,0 +1,196 @@
+import asyncio
+import struct
+import uuid
+
+from nats.aio.errors import ErrTimeout
+
+from .. import codecs
+from .errors import MiteDRPCError
+from .stream import new_inbox
+
+
+CHUNK_MARKER = b'\x02'
+# Chunks of an oversized payload start with this byte (no JSON text or codec marker does) followed by the header below.
+
+_HEADER = struct.Struct('!c16sQQ')
+# marker, transfer id, offset of the chunk in the payload, size of the whole payload
+
+DEFAULT_CHUNK_SIZE = 512 * 1024
+# Payloads above this size are chunked, it has to stay below the broker's max_payload (1MB by default).
+
+MIN_CHUNK_SIZE = 1024
+# Smallest chunk size accepted, it bounds the number of chunks a receiver tracks to max_size / MIN_CHUNK_SIZE.
+
+DEFAULT_MAX_TRANSFER_SIZE = 64 * 1024 * 1024
+# Largest payload a receiver agrees to reassemble.
+
+TRANSFER_TIMEOUT = 10.0
+# How long the receiver waits for the remaining chunks of a payload.
+
+
+class TransferTooLarge(Exception):
+    pass
+
+
+class MalformedChunk(ValueError):
+    pass
+
+
+def is_chunk(data):
+    return data[:1] == CHUNK_MARKER
+
+
+def check_chunk_size(chunk_size):
+    if chunk_size < MIN_CHUNK_SIZE:
+        raise ValueError('chunk_size must be at least {} bytes, got {}'.format(MIN_CHUNK_SIZE, chunk_size))
+    return chunk_size
+
+
+def split(payload, chunk_size):
+    transfer_id = uuid.uuid4().bytes
+    view = memoryview(payload)
+    total = len(payload)
+    return [
+        _HEADER.pack(CHUNK_MARKER, transfer_id, offset, total) + view[offset:offset + chunk_size]
+        for offset in range(0, total, chunk_size)
+    ]
+
+
+class ChunkReceiver:
+    """
+    Reassembles the chunks of one payload into a buffer allocated up front from the size announced by the first one.
+    The first chunk also sets the chunk size, which has to be at least MIN_CHUNK_SIZE unless that chunk holds the whole
+    payload: later chunks have to start on a multiple of it and fill it (except the last one), others and repeated ones
+    are ignored, and the payload is complete once every chunk arrived. Arrived chunks are tracked in a bitmap.
+    """
+    def __init__(self, first_chunk, max_size=DEFAULT_MAX_TRANSFER_SIZE):
+        if len(first_chunk) <= _HEADER.size:
+            raise MalformedChunk('Chunk too short')
+        _, self._transfer_id, offset, total = _HEADER.unpack_from(first_chunk)
+        if total > max_size:
+            raise TransferTooLarge('{} bytes exceeds the transfer size limit of {}'.format(total, max_size))
+        self._chunk_size = len(first_chunk) - _HEADER.size
+        if offset != 0 or self._chunk_size > total:
+            raise MalformedChunk('The first chunk does not start the payload')
+        if self._chunk_size < min(MIN_CHUNK_SIZE, total):
+            raise MalformedChunk('{} bytes chunks are below the minimum of {}'.format(self._chunk_size, MIN_CHUNK_SIZE))
+        self._buffer = bytearray(total)
+        self._view = memoryview(self._buffer)
+        self._chunks = -(-total // self._chunk_size)
+        self._arrived = bytearray(-(-self._chunks // 8))
+        self._received = 0
+        self._complete = asyncio.Event()
+        self.add(first_chunk)
+
+    @property
+    def complete(self):
+        return self._complete.is_set()
+
+    @property
+    def data(self):
+        return self._buffer
+
+    def add(self, chunk):
+        if len(chunk) <= _HEADER.size:
+            return
+        _, transfer_id, offset, _ = _HEADER.unpack_from(chunk)
+        if transfer_id != self._transfer_id or offset >= len(self._buffer) or offset % self._chunk_size:
+            return
+        index, bit = divmod(offset // self._chunk_size, 8)
+        data = memoryview(chunk)[_HEADER.size:]
+        if self._arrived[index] & (1 << bit) or len(data) != min(self._chunk_size, len(self._buffer) - offset):
+            return
+        self._view[offset:offset + len(data)] = data
+        self._arrived[index] |= 1 << bit
+        self._received += 1
+        if self._received == self._chunks:
+            self._complete.set()
+
+    async def on_chunk(self, msg):
+        self.add(msg.data)
+
+    async def wait(self, timeout=TRANSFER_TIMEOUT):
+        await asyncio.wait_for(self._complete.wait(), timeout)
+
+
+async def receive(nc, first_chunk, source, max_size=DEFAULT_MAX_TRANSFER_SIZE, timeout=TRANSFER_TIMEOUT):
+    """
+    Pulls the remaining chunks of a payload from `source`, the subject the sender announced with the first chunk.
+    """
+    receiver = ChunkReceiver(first_chunk, max_size)
+    if receiver.complete:
+        return receiver.data
+    inbox = new_inbox()
+    sid = await nc.subscribe(inbox, cb=receiver.on_chunk)
+    try:
+        await nc.publish_request(source, inbox, b'')
+        await receiver.wait(timeout)
+    finally:
+        await nc.unsubscribe(sid)
+    return receiver.data
+
+
+async def send_reply(nc, subject, payload, chunk_size, timeout=TRANSFER_TIMEOUT):
+    """
+    Publishes the first chunk of an oversized reply to `subject` and the rest once the receiver pulls them.
+    """
+    chunks = split(payload, chunk_size)
+    pulled = asyncio.get_event_loop().create_future()
+
+    async def on_pull(msg):
+        if not pulled.done():
+            pulled.set_result(msg.reply)
+
+    source = new_inbox()
+    sid = await nc.subscribe(source, cb=on_pull)
+    try:
+        await nc.publish_request(subject, source, chunks[0])
+        target = await asyncio.wait_for(pulled, timeout)
+        for chunk in chunks[1:]:
+            await nc.publish(target, chunk)
+    finally:
+        await nc.unsubscribe(sid)
+
+
+async def request(nc, subject, payload, timeout, chunk_size=DEFAULT_CHUNK_SIZE, max_size=DEFAULT_MAX_TRANSFER_SIZE):
+    """
+    timed_request that chunks an oversized request and reassembles an oversized reply. Returns the reply data. With
+    `chunk_size=None` the request is sent whole, whatever its size.
+    """
+    if chunk_size is None or len(payload) <= chunk_size:
+        reply = await nc.timed_request(subject, payload, timeout=timeout)
+    else:
+        reply = await _request_chunked(nc, subject, payload, timeout, chunk_size)
+    if not is_chunk(reply.data):
+        return reply.data
+    try:
+        return await receive(nc, reply.data, reply.reply, max_size, timeout)
+    except TransferTooLarge as err:
+        raise MiteDRPCError({'status': 413, 'body': str(err)})
+    except MalformedChunk as err:
+        raise MiteDRPCError({'status': 502, 'body': str(err)})
+    except asyncio.TimeoutError:
+        raise ErrTimeout
+
+
+async def _request_chunked(nc, subject, payload, timeout, chunk_size):
+    # The first chunk goes through the method subject so a single replica picks up the transfer, it answers with a
+    # 100 Continue carrying the subject the other chunks are sent to.
+    chunks = split(payload, chunk_size)
+    inbox = new_inbox()
+    replies = asyncio.Queue()
+    sid = await nc.subscribe(inbox, cb=replies.put)
+    try:
+        await nc.publish_request(subject, inbox, chunks[0])
+        reply = await asyncio.wait_for(replies.get(), timeout)
+        if not is_chunk(reply.data):
+            _, result = codecs.decode(reply.data)
+            if result['status'] == 100:
+                for chunk in chunks[1:]:
+                    await nc.publish(result['body'], chunk)
+                reply = await asyncio.wait_for(replies.get(), timeout)
+        return reply
+    except asyncio.TimeoutError:
+        raise ErrTimeout
+    finally:
+        await nc.unsubscribe(sid)
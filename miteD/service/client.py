@@ -1,48 +1,425 @@
+import asyncio
 import logging
-from json import loads, dumps
+import time
+from functools import partial
 from nats.aio.errors import ErrTimeout
 
+from . import chunking
+from .cache import ResultCache, make_call_key
+from .envelope import build_request, encode_request, get_call_budget, current_deadline, accepts_envelope, note_reply
+from .stream import new_inbox, build_ack, DEFAULT_STREAM_WINDOW, DEFAULT_STREAM_TIMEOUT
 from .errors import MiteDRPCError
+from .. import codecs, metrics, tracing
 from ..utils import format_version_str
 
 
+BATCH_METHOD = '__batch__'
+# Reserved method name under which a service accepts a list of [method, args] calls in one message.
+
+DESCRIBE_METHOD = '__describe__'
+# Reserved method name under which a service describes the methods of a version.
+
+DEFAULT_TIMEOUT = 3.0
+
+
+def _deadline_exceeded(method_path):
+    return MiteDRPCError({'status': 504, 'body': 'Deadline exceeded before call to: "{}"'.format(method_path)})
+
+
 class RemoteService:
-    def __init__(self, name, version, nc):
+    """
+    Pass `cache=True` (or a ResultCache to configure or share it) to cache results of methods the service marks as
+    cacheable, and `single_flight=True` (or a SingleFlight to share it) to have concurrent identical calls share one
+    request.
+
+    Calls time out after `timeout` seconds, or the value for the method name in `method_timeouts`. Inside a handler of
+    an RPC request, calls are also limited to what is left of that request's deadline.
+
+    Requests larger than `chunk_size` bytes (at least chunking.MIN_CHUNK_SIZE) are sent in chunks, replies are
+    reassembled up to `max_transfer_size`. With `compression` (a compressor name or a codecs.Compression) requests
+    above its threshold are compressed, only use it with services that read compressed requests.
+
+    Calls only wrap their arguments in a request envelope, carrying the deadline and trace context, and are only
+    compressed or chunked, once a reply of the service has shown it reads envelopes. Until then they send the bare
+    argument list that services predating the envelope expect. Batches and streams always use the envelope, such
+    services support neither.
+    """
+    def __init__(
+            self, name, version, nc, codec=None, cache=None, single_flight=None,
+            timeout=DEFAULT_TIMEOUT, method_timeouts=None,
+            chunk_size=chunking.DEFAULT_CHUNK_SIZE, max_transfer_size=chunking.DEFAULT_MAX_TRANSFER_SIZE,
+            compression=None,
+    ):
         self._logger = logging.getLogger('mited.RemoteService')
         self._nc = nc
+        self._codec = codecs.get_codec(codec)
+        self.cache = ResultCache() if cache is True else (None if cache is False else cache)
+        if single_flight is True:
+            single_flight = SingleFlight()
+        self.single_flight = None if single_flight is False else single_flight
+        self._timeout = timeout
+        self._method_timeouts = method_timeouts or {}
+        self._transfer = {
+            'chunk_size': chunking.check_chunk_size(chunk_size),
+            'max_transfer_size': max_transfer_size,
+            'compression': codecs.Compression.get(compression),
+        }
         self._name = name
         self._version = format_version_str(version)
         self._proxy_cache = {}
         self._prefix = 'rpc.service.{}.{}'.format(name, self._version)
+        self._stub = None
 
     def __getattr__(self, item):
-        self._logger.debug('[miteD.RS.__getattr__] %s', item)
-        return MethodProxy(self._nc, '{}.{}'.format(self._prefix, item))
+        proxy = self._proxy_cache.get(item)
+        if proxy is None:
+            self._logger.debug('[miteD.RS.__getattr__] %s', item)
+            proxy = self._proxy_cache[item] = self._get_proxy(item)
+        return proxy
+
+    def _get_proxy(self, item, arity=None):
+        return MethodProxy(
+            self._nc, '{}.{}'.format(self._prefix, item), codec=self._codec, cache=self.cache,
+            single_flight=self.single_flight, timeout=self._method_timeouts.get(item, self._timeout), arity=arity,
+            **self._transfer
+        )
+
+    async def describe(self):
+        return await self._get_proxy(DESCRIBE_METHOD)()
+
+    async def get_stub(self):
+        """
+        Returns a stub with one proxy per method the service exposes for this version, built once from the service's
+        description. Calls with a wrong number of arguments fail locally with a 400.
+        """
+        if self._stub is None:
+            self._stub = build_stub(self, await self.describe())
+        return self._stub
+
+    def batch(self, timeout=None):
+        """
+        Collects calls made on the returned object and sends them to the service in a single message:
+
+            async with service.batch() as batch:
+                pong = batch.ping()
+                total = batch.add(1, 2)
+            print(await pong, await total)
+
+        Each call returns a future resolved with the method result or a MiteDRPCError.
+        """
+        return Batch(self._nc, self._prefix, timeout=timeout or self._timeout, codec=self._codec, **self._transfer)
 
 
 class MethodProxy:
-    def __init__(self, nc, method_path):
+    def __init__(
+            self, nc, method_path, codec=None, cache=None, single_flight=None, timeout=DEFAULT_TIMEOUT, arity=None,
+            chunk_size=chunking.DEFAULT_CHUNK_SIZE, max_transfer_size=chunking.DEFAULT_MAX_TRANSFER_SIZE,
+            compression=None,
+    ):
         self._logger = logging.getLogger('mited.MethodProxy({})'.format(method_path))
         self._nc = nc
+        self._codec = codecs.get_codec(codec)
+        self._cache = cache
+        self._single_flight = single_flight
+        self._timeout = timeout
+        self._arity = arity
+        self._chunk_size = chunk_size
+        self._max_transfer_size = max_transfer_size
+        self._compression = compression
         self._method_path = method_path
+        self._service_prefix = method_path.rsplit('.', 1)[0]
 
     async def __call__(self, *args):
+        if self._arity is not None:
+            self._check_arity(args)
+        call_key = None
+        if self._cache is not None or self._single_flight is not None:
+            call_key = make_call_key(self._method_path, args)
+        if call_key is None:
+            return await self._call(args)
+        cache_key = None
+        if self._cache is not None:
+            hit, result = self._cache.get(call_key)
+            if hit:
+                return result
+            cache_key = call_key
+        if self._single_flight is not None:
+            return await self._single_flight.do(call_key, partial(self._call, args, cache_key))
+        return await self._call(args, cache_key)
+
+    async def stream(self, *args, window=DEFAULT_STREAM_WINDOW, timeout=DEFAULT_STREAM_TIMEOUT):
+        """
+        Calls a method implemented as an async generator and yields its items as they arrive:
+
+            async for read in service.reads.stream(run_id):
+                ...
+
+        The service sends at most `window` items ahead of the ones consumed here, `timeout` bounds the wait for each
+        item. Methods that are not generators yield their single result.
+        """
+        if self._arity is not None:
+            self._check_arity(args)
+        inbox = new_inbox()
+        replies = asyncio.Queue()
+        sid = await self._nc.subscribe(inbox, cb=replies.put)
+        received = 0
+        ack_every = max(1, window // 2)
+        ack_subject = None
+        finished = False
+        status = 'error'
+        span = tracing.start_child('stream ' + self._method_path)
+        try:
+            self._logger.debug('<- %s %s (stream)', self._method_path, args)
+            request = build_request(
+                args, current_deadline.get(), stream={'window': window, 'timeout': timeout},
+                compression=codecs.get_compressor_names(), trace=tracing.get_outgoing_context(span),
+            )
+            payload = encode_request(request, self._codec, self._compression)
+            await self._nc.publish_request(self._method_path, inbox, payload)
+            while True:
+                try:
+                    reply = await asyncio.wait_for(replies.get(), timeout)
+                except asyncio.TimeoutError:
+                    msg = 'Stream timeout for: "{}"'.format(self._method_path)
+                    status = 'timeout'
+                    raise MiteDRPCError({'status': 504, 'body': msg})
+                _, result = codecs.decode(reply.data, self._codec, self._max_transfer_size)
+                status = result['status']
+                if status == 206:
+                    received += 1
+                    ack_subject = reply.reply
+                    if ack_subject and received % ack_every == 0:
+                        await self._nc.publish(ack_subject, codecs.encode(build_ack(received)))
+                    yield result['body']
+                elif status == 204:
+                    finished = True
+                    return
+                elif status == 200:
+                    finished = True
+                    yield result['body']
+                    return
+                else:
+                    finished = True
+                    raise MiteDRPCError(result)
+        finally:
+            if not finished and ack_subject:
+                await self._nc.publish(ack_subject, codecs.encode(build_ack(received, cancel=True)))
+            await self._nc.unsubscribe(sid)
+            tracing.finish_child(span, status=status, items=received)
+
+    def _check_arity(self, args):
+        min_args, max_args = self._arity
+        if len(args) < min_args or (max_args is not None and len(args) > max_args):
+            expected = min_args if min_args == max_args else '{} to {}'.format(min_args, max_args or 'any')
+            msg = '"{}" takes {} arguments, got {}'.format(self._method_path, expected, len(args))
+            raise MiteDRPCError({'status': 400, 'body': msg})
+
+    async def _call(self, args, cache_key=None):
+        timeout, deadline = get_call_budget(self._timeout)
+        if timeout <= 0:
+            raise _deadline_exceeded(self._method_path)
+        started = time.perf_counter()
+        status = 'error'
+        span = tracing.start_child('call ' + self._method_path)
+        trace = tracing.get_outgoing_context(span)
         try:
             self._logger.debug('<- %s %s', self._method_path, args)
-            reply = await self._nc.timed_request(self._method_path, dumps(args).encode(), timeout=3.0)
-            return self.__get_result(reply)
+            if accepts_envelope(self._service_prefix):
+                request = build_request(
+                    args, deadline, compression=codecs.get_compressor_names(), chunking=True, trace=trace
+                )
+                payload = encode_request(request, self._codec, self._compression)
+                chunk_size = self._chunk_size
+            else:
+                # Services predating the envelope read neither compressed nor chunked requests.
+                payload = codecs.encode(list(args), self._codec)
+                chunk_size = None
+            reply = await chunking.request(
+                self._nc, self._method_path, payload, timeout, chunk_size, self._max_transfer_size
+            )
+            status = 200
+            return self.__get_result(reply, cache_key)
         except ErrTimeout:
             msg = 'Call timeout for: "{}"'.format(self._method_path)
-            status = 504
-            raise MiteDRPCError({'status': status, 'body': msg})
+            status = 'timeout'
+            raise MiteDRPCError({'status': 504, 'body': msg})
         except MiteDRPCError as err:
+            status = err.status
             raise err
+        finally:
+            metrics.rpc_client_latency.labels(self._method_path).observe(time.perf_counter() - started)
+            metrics.rpc_client_requests.labels(self._method_path, status).inc()
+            tracing.finish_child(span, status=status)
 
-    def __get_result(self, reply):
-        result = loads(reply.data.decode())
+    def __get_result(self, reply, cache_key=None):
+        _, result = codecs.decode(reply, self._codec, self._max_transfer_size)
         self._logger.debug(result)
+        note_reply(self._service_prefix, result)
         status = result['status']
         if status == 200:
+            if cache_key is not None:
+                self._cache.put(cache_key, result['body'], result.get('cache_ttl'))
             return result['body']
         else:
             raise MiteDRPCError(result)
+
+
+class ServiceStub:
+    __slots__ = ('_description', )
+
+    def __init__(self, description):
+        self._description = description
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, ' '.join(self.__slots__))
+
+
+def build_stub(service, description):
+    methods = {
+        name: method for name, method in description['methods'].items()
+        if name.isidentifier() and not name.startswith('_')
+    }
+    stub_cls = type(
+        '{}Stub'.format(description['service'].title().replace('_', '').replace('-', '')),
+        (ServiceStub, ),
+        {'__slots__': tuple(methods)},
+    )
+    stub = stub_cls(description)
+    for name, method in methods.items():
+        setattr(stub, name, service._get_proxy(name, arity=(method['min_args'], method['max_args'])))
+    return stub
+
+
+class SingleFlight:
+    """
+    Lets concurrent calls with the same key await one shared request, all of them getting its result or error.
+    """
+    def __init__(self):
+        self._flights = {}
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key, fn):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(fn())
+            flight.add_done_callback(partial(self._done, key))
+        else:
+            self.shared += 1
+        return await asyncio.shield(flight)
+
+    def _done(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+
+def is_batch_reply(reply, calls):
+    """
+    Whether a reply to a batch of `calls` calls is an error or carries one result per call.
+    """
+    if not isinstance(reply, dict) or 'status' not in reply:
+        return False
+    if reply['status'] != 200:
+        return True
+    results = reply.get('body')
+    return (
+        isinstance(results, list) and len(results) == calls
+        and all(isinstance(result, dict) and 'status' in result for result in results)
+    )
+
+
+class Batch:
+    def __init__(
+            self, nc, prefix, timeout=DEFAULT_TIMEOUT, codec=None,
+            chunk_size=chunking.DEFAULT_CHUNK_SIZE, max_transfer_size=chunking.DEFAULT_MAX_TRANSFER_SIZE,
+            compression=None,
+    ):
+        self._logger = logging.getLogger('mited.Batch({})'.format(prefix))
+        self._nc = nc
+        self._codec = codecs.get_codec(codec)
+        self._method_path = '{}.{}'.format(prefix, BATCH_METHOD)
+        self._timeout = timeout
+        self._chunk_size = chunk_size
+        self._max_transfer_size = max_transfer_size
+        self._compression = compression
+        self._calls = []
+        self._futures = []
+
+    def __getattr__(self, item):
+        return partial(self._add_call, item)
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.send()
+        else:
+            self.cancel()
+
+    def _add_call(self, method, *args):
+        future = asyncio.get_event_loop().create_future()
+        self._calls.append((method, args))
+        self._futures.append(future)
+        return future
+
+    def cancel(self):
+        for future in self._futures:
+            future.cancel()
+        self._calls, self._futures = [], []
+
+    async def send(self):
+        calls, futures = self._calls, self._futures
+        self._calls, self._futures = [], []
+        if not calls:
+            return futures
+        timeout, deadline = get_call_budget(self._timeout)
+        span = tracing.start_child('call ' + self._method_path)
+        # Whatever happens, every future gets resolved; this is what they get if the batch fails unexpectedly.
+        result = {'status': 500, 'body': 'Batch call to "{}" failed'.format(self._method_path)}
+        try:
+            if timeout <= 0:
+                raise _deadline_exceeded(self._method_path)
+            self._logger.debug('<- %s %s calls', self._method_path, len(calls))
+            request = build_request(
+                calls, deadline, compression=codecs.get_compressor_names(), chunking=True,
+                trace=tracing.get_outgoing_context(span),
+            )
+            payload = encode_request(request, self._codec, self._compression)
+            reply = await chunking.request(
+                self._nc, self._method_path, payload, timeout, self._chunk_size, self._max_transfer_size
+            )
+            _, reply = codecs.decode(reply, self._codec, self._max_transfer_size)
+            if is_batch_reply(reply, len(calls)):
+                result = reply
+            else:
+                result = {'status': 502, 'body': 'Malformed batch reply from "{}"'.format(self._method_path)}
+        except ErrTimeout:
+            msg = 'Call timeout for: "{}"'.format(self._method_path)
+            result = {'status': 504, 'body': msg}
+        except MiteDRPCError as err:
+            result = {'status': err.status, 'body': err.message}
+        finally:
+            tracing.finish_child(span, status=result['status'], calls=len(calls))
+            self._logger.debug(result)
+            if result['status'] == 200:
+                for future, call_result in zip(futures, result['body']):
+                    self._resolve(future, call_result)
+            else:
+                for future in futures:
+                    self._resolve(future, result)
+        return futures
+
+    @staticmethod
+    def _resolve(future, result):
+        if future.done():
+            return
+        if result['status'] == 200:
+            future.set_result(result['body'])
+        else:
+            future.set_exception(MiteDRPCError(result))
@@ -0,0 +1,94 @@
+import time
+from contextvars import ContextVar
+
+from .. import codecs
+
+
+current_deadline = ContextVar('mited_deadline', default=None)
+# Absolute deadline (unix time) of the RPC request being handled, inherited by the calls a handler makes.
+
+ENVELOPE_MARKER = b'\x05'
+# Requests start with this byte followed by the encoded envelope. Peers that predate the envelope can not decode such a
+# request and answer it with a 400, which is why callers only send envelopes to services known to read them, see
+# accepts_envelope.
+
+ENVELOPE_SUPPORT_KEY = 'envelope'
+# Replies carry this key set to True to tell callers the service reads request envelopes.
+
+_NO_META = {}
+
+_envelope_peers = set()
+
+
+def build_request(args, deadline=None, **meta):
+    """
+    Requests used to be the bare argument list. They are now an envelope carrying the arguments next to call metadata,
+    services still accept the bare list from older clients.
+    """
+    request = {'args': args, 'deadline': deadline}
+    request.update((key, value) for key, value in meta.items() if value is not None)
+    return request
+
+
+def encode_request(request, codec=None, compression=None):
+    return codecs.encode(request, codec, compression, ENVELOPE_MARKER)
+
+
+def accepts_envelope(prefix):
+    """
+    Whether the service at `prefix` ('rpc.service.<name>.<version>') is known to read request envelopes. Until one of
+    its replies has shown it does, callers send it the bare argument list, which services of every version read.
+    """
+    return prefix in _envelope_peers
+
+
+def note_reply(prefix, reply):
+    """
+    Records from a decoded reply whether the service at `prefix` reads request envelopes. Replies without the key come
+    from services predating the envelope, e.g. after a rollback, and send the following calls back to bare lists.
+    """
+    if isinstance(reply, dict) and reply.get(ENVELOPE_SUPPORT_KEY) is True:
+        _envelope_peers.add(prefix)
+    else:
+        _envelope_peers.discard(prefix)
+
+
+def parse_request(data):
+    """
+    Returns the arguments and the metadata of a decoded request.
+    """
+    if isinstance(data, dict):
+        # Sent unmarked by clients predating ENVELOPE_MARKER.
+        return data.get('args', ()), data
+    return data, _NO_META
+
+
+def decode_request(data, codec=None, max_size=codecs.DEFAULT_MAX_DECOMPRESSED_SIZE):
+    """
+    Returns the codec a request was encoded with, its arguments and its metadata. Raises a ValueError for payloads that
+    are not a request or decompress to more than `max_size` bytes.
+    """
+    data = codecs.decompress(data, max_size)
+    if data[:1] == ENVELOPE_MARKER:
+        codec, request = codecs.decode(memoryview(data)[1:], codec)
+        if not isinstance(request, dict):
+            raise codecs.CodecError('Malformed request envelope')
+    else:
+        codec, request = codecs.decode(data, codec)
+    args, meta = parse_request(request)
+    if not isinstance(args, (list, tuple)):
+        raise codecs.CodecError('Request arguments must be a list')
+    return codec, args, meta
+
+
+def get_call_budget(timeout):
+    """
+    Returns the timeout for an outgoing call and its absolute deadline, shortened to what is left of the deadline of
+    the request being handled, if any.
+    """
+    now = time.time()
+    deadline = now + timeout
+    inherited = current_deadline.get()
+    if inherited is not None and inherited < deadline:
+        return inherited - now, inherited
+    return timeout, deadline
@@ -2,17 +2,30 @@ from http import HTTPStatus
 
 
 def _build_response(status, body):
-    return {'status': status, 'body': body}
+    # A plain int, HTTPStatus members render as 'HTTPStatus.OK' in metric labels and logs on Python < 3.11.
+    return {'status': int(status), 'body': body}
 
 
 def _build_error(status):
-    return _build_response(status.value, status.phrase)
+    return _build_response(status, status.phrase)
+
+
+def continue_transfer(location):
+    return _build_response(HTTPStatus.CONTINUE, location)
 
 
 def ok(reply=None):
     return _build_response(HTTPStatus.OK, reply)
 
 
+def partial_content(reply=None):
+    return _build_response(HTTPStatus.PARTIAL_CONTENT, reply)
+
+
+def no_content(*args):
+    return _build_response(HTTPStatus.NO_CONTENT, None)
+
+
 def bad_request(*args):
     return _build_error(HTTPStatus.BAD_REQUEST)
 
@@ -25,9 +38,17 @@ def not_found(*args):
     return _build_error(HTTPStatus.NOT_FOUND)
 
 
+def payload_too_large(*args):
+    return _build_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+
 def internal_server_error(*args):
     return _build_error(HTTPStatus.INTERNAL_SERVER_ERROR)
 
 
+def service_unavailable(*args):
+    return _build_error(HTTPStatus.SERVICE_UNAVAILABLE)
+
+
 def temporary_redirect(location):
     return _build_response(HTTPStatus.TEMPORARY_REDIRECT, location)
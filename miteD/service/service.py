@@ -1,11 +1,21 @@
 import asyncio
+import inspect
 import logging
-import json
-from datetime import datetime
+import signal
+import time
+from collections import deque
+from functools import partial
 from nats.aio.client import Client as NATS
 
-from .client import RemoteService
-from ..utils import get_members_if, format_version_str, CustomJsonEncoder
+from . import chunking
+from .access_log import AccessLog
+from .client import RemoteService, BATCH_METHOD, DESCRIBE_METHOD
+from .envelope import decode_request, current_deadline, ENVELOPE_SUPPORT_KEY
+from .stream import StreamCredit, StreamCancelled, new_inbox, DEFAULT_STREAM_WINDOW, DEFAULT_STREAM_TIMEOUT
+from ..utils import get_members_if, format_version_str
+from .. import codecs, loops, metrics, prefork, tracing
+from ..connections import ConnectionPool
+from ..executors import Executors, set_executor, get_executor
 from ..mixin.notifications import NotificationsMixin
 from . import response
 
@@ -24,107 +34,507 @@ def parse_wrapped_endpoints(cls):
     return endpoints
 
 
+def get_rpc_prefix(service_name, api_version):
+    return 'rpc.service.{}.{}'.format(service_name, api_version)
+
+
+def is_batch(calls):
+    """
+    Whether the body of a batch request is a list of [method name, arguments] pairs.
+    """
+    return isinstance(calls, (list, tuple)) and all(
+        isinstance(call, (list, tuple)) and len(call) == 2 and isinstance(call[0], str)
+        and isinstance(call[1], (list, tuple))
+        for call in calls
+    )
+
+
+def compile_dispatch_table(service_name, versions, endpoints):
+    """
+    Flattens the endpoints into a subject -> handler dict, resolving the '*' version fallbacks once so a request needs a
+    single lookup.
+    """
+    table = {}
+    for version in versions:
+        prefix = get_rpc_prefix(service_name, version)
+        for api_version in ('*', version):
+            for api_method, handler in endpoints.get(api_version, {}).items():
+                table['{}.{}'.format(prefix, api_method)] = handler
+    return table
+
+
+def describe_method(handler):
+    parameters = inspect.signature(handler).parameters.values()
+    positional = [p for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    variadic = any(p.kind == p.VAR_POSITIONAL for p in parameters)
+    return {
+        'signature': str(inspect.signature(handler)),
+        'min_args': len([p for p in positional if p.default is p.empty]),
+        'max_args': None if variadic else len(positional),
+        'cache_ttl': handler.__rpc_cache_ttl__,
+        'doc': inspect.getdoc(handler),
+    }
+
+
+def describe_dispatch_table(service_name, versions, dispatch):
+    """
+    Builds the reply of the introspection method for each version prefix.
+    """
+    descriptions = {}
+    for version in versions:
+        prefix = get_rpc_prefix(service_name, version)
+        descriptions[prefix] = {
+            'service': service_name,
+            'version': version,
+            'versions': list(versions),
+            'methods': {
+                subject[len(prefix) + 1:]: describe_method(handler)
+                for subject, handler in dispatch.items() if subject.startswith(prefix + '.')
+            },
+        }
+    return descriptions
+
+
 def rpc_service(
         name,
         versions,
         broker_urls=('nats://127.0.0.1:4222',),
         notification_topics=None,
+        codec=codecs.DEFAULT_CODEC,
+        subscribe_per_method=False,
+        max_in_flight=None,
+        max_pending=0,
+        thread_pool_size=None,
+        process_pool_size=None,
+        chunk_size=chunking.DEFAULT_CHUNK_SIZE,
+        max_transfer_size=chunking.DEFAULT_MAX_TRANSFER_SIZE,
+        compression=None,
+        topic_compression=None,
+        notification_batching=None,
+        streaming_cluster=None,
+        durable_topics=(),
+        connections=1,
+        queue_group=True,
+        loop_policy=None,
+        slow_callback_duration=None,
+        expose_metrics=True,
+        tracer=None,
+        untraced_topics=(),
+        access_log=None,
 ):
+    """
+    With `subscribe_per_method` the service subscribes to each concrete method subject instead of one wildcard per
+    version, so calls to unknown methods are never delivered to it (and time out on the caller's side instead of
+    getting a 404).
+
+    `max_in_flight` caps the number of requests handled concurrently. Up to `max_pending` further requests wait for a
+    free slot, anything beyond that is answered right away with a 503 and counted in `shed_count`.
+
+    `thread_pool_size`/`process_pool_size` size the pools used by handlers declared with an `executor`.
+
+    Replies larger than `chunk_size` bytes (at least chunking.MIN_CHUNK_SIZE) are sent in chunks to callers that say
+    they reassemble them, others get a single message; chunked requests are accepted up to `max_transfer_size`.
+
+    `compression` (a compressor name or a codecs.Compression) compresses replies to callers that accept it and
+    notifications; `topic_compression` overrides it per notification topic. Requests made through get_remote_service
+    are only compressed when it is given a `compression` of its own, since the service called may not read them.
+    Compressed requests are accepted up to `max_transfer_size` once decompressed.
+
+    `notification_batching` maps notification topics to a batch size (or a mixin.batching.Batching): notifications on
+    those topics are buffered and published together, see notification_handler(batch_size=...) for the consumer side.
+
+    `streaming_cluster` is the cluster id of a NATS Streaming server reached through the broker, needed by the
+    `durable_topics` (notification topics published through it) and by handlers declared with
+    notification_handler(durable_name=...).
+
+    With `connections` > 1 the service spreads its subscriptions and outgoing messages over a pool of that many broker
+    connections, by subject.
+
+    RPC subscriptions join a queue group so each call is handled by one replica, except for methods declared with
+    `rpc_method(broadcast=True)`; `queue_group=False` makes every replica handle every call.
+
+    The event loop is created by start(): `loop_policy` is 'uvloop', 'asyncio' or an event loop policy, by default
+    uvloop when it is installed. `slow_callback_duration` (seconds) runs the loop in debug mode, logging the callbacks
+    that block it for longer than that.
+
+    With `expose_metrics` every process of the service answers requests on 'metrics.service.<name>' with its metrics
+    (see miteD.metrics) in the Prometheus text format.
+
+    `tracer` (a tracing.Tracer) records spans of the requests the service handles, continuing the trace of the caller,
+    and of the calls and notifications it makes while handling them. Notifications published within a sampled trace
+    are prefixed with its context (tracing.TRACE_MARKER), which consumers predating tracing can not decode: the
+    notification topics in `untraced_topics` are always published without it.
+
+    Replies are logged to 'mited.rpc.access' off the event loop by `access_log` (an access_log.AccessLog, which also
+    samples and filters them by status); `access_log=False` turns the access log off.
+    """
+    chunking.check_chunk_size(chunk_size)
+
     def wrapper(cls):
         class Service(NotificationsMixin):
             _layer = 'service'
             _name = name
-            _loop = asyncio.get_event_loop()
+            _loop = None
             _broker_urls = broker_urls
             _notification_topics = notification_topics or []
-            _nc = NATS()
+            _nc = ConnectionPool(connections) if connections > 1 else NATS()
             _versions = [format_version_str(v) for v in versions]
+            _codec = codecs.get_codec(codec)
+            _compression = codecs.Compression.get(compression)
+            _topic_compression = topic_compression or {}
+            _notification_batching = notification_batching or {}
+            _streaming_cluster = streaming_cluster
+            _durable_topics = tuple(durable_topics)
+            _untraced_topics = tuple(untraced_topics)
 
             def __init__(self):
                 self._logger = logging.getLogger('mited.Service({})'.format(self._name))
-                self._access_log = logging.getLogger('mited.rpc.access')
+                self._access_log = AccessLog() if access_log is None else access_log or None
+                self._in_flight = 0
+                self._pending = deque()
+                self.shed_count = 0
+                self.expired_count = 0
+                self.executors = Executors(thread_pool_size, process_pool_size)
+                if tracer is not None:
+                    tracer.service = tracer.service or self._name
+                    tracing.set_tracer(tracer)
                 self._add_notify(cls)
                 cls.loop = self._loop
+                cls.executors = self.executors
                 cls.get_remote_service = self.get_remote_service
                 self.endpoints = parse_wrapped_endpoints(cls)
+                self._dispatch = compile_dispatch_table(self._name, self._versions, self.endpoints)
+                self._descriptions = describe_dispatch_table(self._name, self._versions, self._dispatch)
+                self._broadcast_subjects = {
+                    subject for subject, handler in self._dispatch.items() if handler.__rpc_broadcast__
+                } if queue_group else set()
                 self.notification_handlers = self.get_notification_handlers(cls)
 
-            def start(self):
-                asyncio.ensure_future(self._start())
+            def start(self, workers=None):
+                """
+                With `workers` > 1 (or the MITED_WORKERS environment variable) the service forks that many worker
+                processes, each with its own loop and broker connection, and supervises them until it is signalled.
+                """
+                workers = prefork.get_workers(workers)
+                if workers > 1:
+                    return prefork.Prefork(self._start_worker, workers, self._logger).run()
+                self._new_loop()
+                self._loop.create_task(self._start())
                 self._loop.run_forever()
                 self._loop.close()
 
             def stop(self):
                 self._logger.info('Stopping...')
-                group = asyncio.gather(*asyncio.Task.all_tasks(), return_exceptions=True)
+                self._loop.run_until_complete(self._close_notifications())
+                if self._nc.is_connected:
+                    self._loop.run_until_complete(self._nc.close())
+                group = asyncio.gather(*asyncio.all_tasks(self._loop), return_exceptions=True)
                 group.cancel()
                 self._loop.run_until_complete(group)
                 self._loop.close()
+                self.executors.shutdown()
+                if tracer is not None:
+                    tracer.close()
+                if self._access_log is not None:
+                    self._access_log.close()
+
+            def _new_loop(self):
+                self._loop = cls.loop = loops.new_event_loop(loop_policy, slow_callback_duration)
+
+            def _start_worker(self, index):
+                self._new_loop()
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    self._loop.add_signal_handler(sig, self._loop.stop)
+                self._logger = logging.getLogger('mited.Service({})[{}]'.format(self._name, index))
+                self._loop.create_task(self._start())
+                self._loop.run_forever()
+                self.stop()
 
             async def _start(self):
                 self._logger.info('Connecting to %s', self._broker_urls)
                 await self._nc.connect(io_loop=self._loop, servers=self._broker_urls, verbose=True, name=self._name)
                 await self._start_notification_handlers()
-                return await asyncio.wait([self._expose_api_version(name, version) for version in self._versions])
+                if expose_metrics:
+                    await self._expose_metrics()
+                return await asyncio.gather(*[self._expose_api_version(name, version) for version in self._versions])
+
+            @property
+            def in_flight(self):
+                return self._in_flight
+
+            @property
+            def pending(self):
+                return len(self._pending)
 
             async def handle_message(self, message):
-                asyncio.ensure_future(self._handle_request(message))
+                if message.subject in self._broadcast_subjects:
+                    # Also delivered to this replica by its own subscription, see _expose_api_version.
+                    return
+                await self.handle_broadcast_message(message)
 
-            def get_remote_service(self, service_name, version):
+            async def handle_broadcast_message(self, message):
+                if max_in_flight is None or self._in_flight < max_in_flight:
+                    self._start_request(message)
+                elif len(self._pending) < max_pending:
+                    self._pending.append(message)
+                else:
+                    self.shed_count += 1
+                    metrics.rpc_server_shed.labels(self._name).inc()
+                    await self._send_reply(message, response.service_unavailable())
+
+            def _start_request(self, message):
+                self._in_flight += 1
+                metrics.rpc_server_in_flight.labels(self._name).inc()
+                task = asyncio.ensure_future(self._handle_request(message))
+                task.add_done_callback(partial(self._request_done, message.subject, time.perf_counter()))
+
+            def _request_done(self, subject, started, task):
+                self._in_flight -= 1
+                metrics.rpc_server_in_flight.labels(self._name).dec()
+                metrics.rpc_server_latency.labels(self._get_metrics_subject(subject)).observe(
+                    time.perf_counter() - started
+                )
+                if self._pending:
+                    self._start_request(self._pending.popleft())
+
+            def get_remote_service(self, service_name, version, codec=None, **options):
                 self._logger.debug('Remote service: %s %s', service_name, version)
-                return RemoteService(name=service_name, version=version, nc=self._nc)
-
-            def _get_handler(self, msg):
-                subject = msg.subject
-                api_version = subject.split('.')[3]
-                api_method = subject.split('.')[4]
-                api = self.endpoints.get(api_version, self.endpoints['*'])
-                method = api.get(api_method, self.endpoints['*'].get(api_method, None))
+                return RemoteService(
+                    name=service_name, version=version, nc=self._nc, codec=codec or self._codec, **options
+                )
+
+            def _get_handler(self, subject):
+                method = self._dispatch.get(subject)
                 if method:
                     return method
                 else:
                     raise NotImplementedError(subject)
 
             async def _expose_api_version(self, api, api_version):
-                subject = '{}.{}.{}.{}.*'.format('rpc', 'service', api, api_version)
-                self._logger.info('listening for RPC calls on ' + subject)
-                await self._nc.subscribe(subject, cb=self.handle_message)
+                prefix = get_rpc_prefix(api, api_version)
+                broadcast = [subject for subject in self._broadcast_subjects if subject.startswith(prefix + '.')]
+                if subscribe_per_method:
+                    subjects = [
+                        subject for subject in self._dispatch
+                        if subject.startswith(prefix + '.') and subject not in self._broadcast_subjects
+                    ]
+                    subjects.extend('{}.{}'.format(prefix, method) for method in (BATCH_METHOD, DESCRIBE_METHOD))
+                else:
+                    subjects = [prefix + '.*']
+                queue = prefix if queue_group else ''
+                for subject in subjects:
+                    self._logger.info("listening for RPC calls on subject/queue: '{}'/'{}'".format(subject, queue))
+                    if queue and isinstance(self._nc, ConnectionPool):
+                        await self._nc.subscribe_spread(subject, queue=queue, cb=self.handle_message)
+                    else:
+                        await self._nc.subscribe(subject, queue=queue, cb=self.handle_message)
+                for subject in broadcast:
+                    self._logger.info('listening for broadcast RPC calls on ' + subject)
+                    await self._nc.subscribe(subject, cb=self.handle_broadcast_message)
 
             async def _handle_request(self, request):
+                data = request.data
+                if chunking.is_chunk(data):
+                    try:
+                        data = await self._receive_chunks(request)
+                    except chunking.TransferTooLarge:
+                        return await self._send_reply(request, response.payload_too_large())
+                    except chunking.MalformedChunk:
+                        return await self._send_reply(request, response.bad_request())
+                    except asyncio.TimeoutError:
+                        self._logger.warning('Timed out receiving chunks of a request to %s', request.subject)
+                        return
+                metrics.rpc_server_request_size.labels(self._get_metrics_subject(request.subject)).observe(len(data))
+                try:
+                    codec, args, meta = decode_request(data, self._codec, max_transfer_size)
+                except ValueError:
+                    return await self._send_reply(request, response.bad_request())
+                span = tracing.start_span(request.subject, meta.get('trace'))
+                try:
+                    return await self._handle_call(request, args, meta, codec)
+                finally:
+                    tracing.finish_span(span)
+
+            async def _handle_call(self, request, args, meta, codec):
+                compression = None
+                if self._compression and self._compression.compressor.name in meta.get('compression', ()):
+                    compression = self._compression
+                deadline = meta.get('deadline')
+                if deadline is None:
+                    reply = await self._get_call(request, args, meta, codec, compression)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return self._drop_expired(request)
+                    current_deadline.set(deadline)
+                    try:
+                        call = self._get_call(request, args, meta, codec, compression)
+                        reply = await asyncio.wait_for(call, remaining)
+                    except asyncio.TimeoutError:
+                        return self._drop_expired(request)
+                if reply is not None:
+                    return await self._send_reply(request, reply, codec, compression, meta.get('chunking') is True)
+
+            def _get_call(self, request, args, meta, codec, compression=None):
+                subject = request.subject
+                if 'stream' in meta and inspect.isasyncgenfunction(self._dispatch.get(subject)):
+                    return self._stream_method(request, args, meta['stream'], codec, compression)
+                if subject not in self._dispatch:
+                    prefix, api_method = subject.rsplit('.', 1)
+                    if api_method == BATCH_METHOD:
+                        return self._call_batch(prefix + '.', args)
+                    if api_method == DESCRIBE_METHOD:
+                        return self._describe(prefix)
+                return self._call_method(subject, args)
+
+            async def _describe(self, prefix):
+                return response.ok(self._descriptions[prefix])
+
+            def _drop_expired(self, request):
+                # The caller has given up on this request, nobody would read a reply.
+                self.expired_count += 1
+                metrics.rpc_server_expired.labels(self._get_metrics_subject(request.subject)).inc()
+                self._logger.debug('Dropped request past its deadline: %s', request.subject)
+
+            async def _call_batch(self, prefix, calls):
+                if not is_batch(calls):
+                    return response.bad_request()
+                results = await asyncio.gather(
+                    *[self._call_method(prefix + api_method, data) for api_method, data in calls],
+                    return_exceptions=True
+                )
+                replies = []
+                for result in results:
+                    if isinstance(result, Exception):
+                        self._logger.error('Batched call failed', exc_info=result)
+                        result = response.internal_server_error()
+                    replies.append(result)
+                return response.ok(replies)
+
+            async def _call_method(self, subject, data):
                 try:
-                    method = self._get_handler(request)
-                    data = self._get_payload(request)
-                    result = await method(*data)
+                    method = self._get_handler(subject)
+                    if get_executor(method):
+                        result = await self._call_in_executor(method, data)
+                    elif inspect.isasyncgenfunction(method):
+                        result = [item async for item in method(*data)]
+                    else:
+                        result = await method(*data)
                     if asyncio.iscoroutine(result):
                         result = await result
-                    return await self._send_reply(request, response.ok(result))
+                    reply = response.ok(result)
+                    if method.__rpc_cache_ttl__ is not None:
+                        reply['cache_ttl'] = method.__rpc_cache_ttl__
+                    return reply
                 except NotImplementedError:
-                    return await self._send_reply(request, response.not_found())
-                except json.JSONDecodeError:
-                    return await self._send_reply(request, response.bad_request())
+                    return response.not_found()
+                except RuntimeError:
+                    return response.internal_server_error()
+
+            async def _call_in_executor(self, method, data):
+                try:
+                    return await self.executors.call(method.__func__, method.__self__, *data)
+                except Exception as error:
+                    # Whatever the handler raised in the pool, or a broken pool, is answered with a 500.
+                    self._logger.exception('%s failed in its executor', method.__name__)
+                    raise RuntimeError(method.__name__) from error
+
+            async def _stream_method(self, request, data, options, codec, compression=None):
+                """
+                Sends each item an async generator handler yields as its own reply message, sending ahead at most
+                `window` items the caller has not acknowledged. Returns the reply that ends the stream, or None if the
+                caller went away.
+                """
+                credit = StreamCredit(options.get('window') or DEFAULT_STREAM_WINDOW)
+                timeout = options.get('timeout') or DEFAULT_STREAM_TIMEOUT
+                ack_inbox = new_inbox()
+                sid = await self._nc.subscribe(ack_inbox, cb=credit.on_ack)
+                items = self._get_handler(request.subject)(*data)
+                sent = 0
+                try:
+                    async for item in items:
+                        await credit.wait(sent, timeout)
+                        body = codecs.encode(response.partial_content(item), codec, compression)
+                        await self._nc.publish_request(request.reply, ack_inbox, body)
+                        sent += 1
+                    return response.no_content()
+                except (StreamCancelled, asyncio.TimeoutError):
+                    self._logger.debug('Stream abandoned by the caller after %s items: %s', sent, request.subject)
+                    return None
                 except RuntimeError:
-                    return await self._send_reply(request, response.internal_server_error())
+                    return response.internal_server_error()
+                finally:
+                    await items.aclose()
+                    await self._nc.unsubscribe(sid)
 
-            def _send_reply(self, request, reply):
-                body = json.dumps(reply, cls=CustomJsonEncoder).encode()
+            async def _receive_chunks(self, request):
+                receiver = chunking.ChunkReceiver(request.data, max_transfer_size)
+                if not receiver.complete:
+                    upload = new_inbox()
+                    sid = await self._nc.subscribe(upload, cb=receiver.on_chunk)
+                    try:
+                        await self._nc.publish(request.reply, codecs.encode(response.continue_transfer(upload)))
+                        await receiver.wait()
+                    finally:
+                        await self._nc.unsubscribe(sid)
+                return receiver.data
+
+            async def _send_reply(self, request, reply, codec=None, compression=None, chunked=False):
+                # Callers only send envelopes to services that advertised them, older callers ignore the extra key.
+                reply = dict(reply, **{ENVELOPE_SUPPORT_KEY: True})
+                body = codecs.encode(reply, codec or codecs.get_codec(), compression)
                 self._log_access(request, reply['status'], len(body))
-                return self._nc.publish(request.reply, body)
+                tracing.set_tags(status=reply['status'])
+                subject = self._get_metrics_subject(request.subject)
+                metrics.rpc_server_requests.labels(subject, reply['status']).inc()
+                metrics.rpc_server_reply_size.labels(subject).observe(len(body))
+                if chunked and len(body) > chunk_size:
+                    try:
+                        await chunking.send_reply(self._nc, request.reply, body, chunk_size)
+                    except asyncio.TimeoutError:
+                        self._logger.warning('Caller did not pull the chunked reply to %s', request.subject)
+                else:
+                    await self._nc.publish(request.reply, body)
 
             def _log_access(self, request, status, length):
-                self._access_log.info('[%s]"%s" %s %s', datetime.utcnow().isoformat(), request.subject, status, length)
+                if self._access_log is not None:
+                    self._access_log.record(request.subject, status, length)
+
+            def _get_metrics_subject(self, subject):
+                # Unknown subjects share one label so stray requests cannot grow the metrics without bound.
+                if subject in self._dispatch or subject.rsplit('.', 1)[-1] in (BATCH_METHOD, DESCRIBE_METHOD):
+                    return subject
+                return '<unknown>'
+
+            async def _expose_metrics(self):
+                subject = metrics.get_metrics_subject(self._layer, self._name)
+                self._logger.info("Exposing metrics on subject: '%s'", subject)
+                await self._nc.subscribe(subject, cb=self._reply_metrics)
 
-            @staticmethod
-            def _get_payload(msg):
-                return json.loads(msg.data.decode())
+            async def _reply_metrics(self, request):
+                await self._nc.publish(request.reply, codecs.encode(metrics.render_reply(), self._codec))
 
         return Service
     return wrapper
 
 
-def rpc_method(name='', versions=None):
+def rpc_method(name='', versions=None, executor=None, cache_ttl=None, broadcast=False):
+    """
+    With `executor='thread'` or `executor='process'` the handler is a plain function run in the service's thread or
+    process pool, so blocking or CPU-bound work does not stall the event loop.
+
+    `cache_ttl` (seconds) is advertised in successful replies so clients with a result cache may reuse them.
+
+    Async generator handlers stream their items to callers using `MethodProxy.stream`, plain calls get them as a list.
+
+    Calls to `broadcast` methods are handled by every replica of the service instead of one of them.
+    """
     def wrapper(fn):
+        set_executor(fn, executor)
         fn.__is_rpc_method__ = True
         fn.__rpc_name__ = name or fn.__name__
-        fn.__rpc_versions__ = (format_version_str(v) for v in versions) if versions else ('*', )
+        fn.__rpc_cache_ttl__ = cache_ttl
+        fn.__rpc_broadcast__ = broadcast
+        fn.__rpc_versions__ = tuple(format_version_str(v) for v in versions) if versions else ('*', )
         return fn
     return wrapper
@@ -0,0 +1,47 @@
+import asyncio
+import uuid
+
+from .. import codecs
+
+
+DEFAULT_STREAM_WINDOW = 16
+# Number of items a service may send ahead of the caller's acknowledgements.
+
+DEFAULT_STREAM_TIMEOUT = 30.0
+# How long either side waits for the next item or acknowledgement before giving up on a stream.
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+def new_inbox():
+    return '_INBOX.{}'.format(uuid.uuid4().hex)
+
+
+def build_ack(received, cancel=False):
+    return {'received': received, 'cancel': cancel}
+
+
+class StreamCredit:
+    """
+    Service side flow control of a stream: items may only be sent while fewer than `window` of them are unacknowledged.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.acked = 0
+        self.cancelled = False
+        self._acked = asyncio.Event()
+
+    async def on_ack(self, msg):
+        _, ack = codecs.decode(msg.data)
+        self.acked = max(self.acked, ack['received'])
+        self.cancelled = self.cancelled or ack.get('cancel', False)
+        self._acked.set()
+
+    async def wait(self, sent, timeout):
+        while sent - self.acked >= self.window and not self.cancelled:
+            self._acked.clear()
+            await asyncio.wait_for(self._acked.wait(), timeout)
+        if self.cancelled:
+            raise StreamCancelled()
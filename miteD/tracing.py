@@ -0,0 +1,255 @@
+import json
+import logging
+import queue
+import random
+import struct
+import time
+from contextvars import ContextVar
+
+from .prefork import ProcessThread
+
+
+current_span = ContextVar('mited_span', default=None)
+# Span of the request or notification being handled, NOT_SAMPLED when its trace was not sampled.
+
+NOT_SAMPLED = object()
+
+TRACE_MARKER = b'\x04'
+# A notification payload starting with this byte is prefixed with the trace context it was published in.
+
+_NOTIFICATION_HEADER = struct.Struct('!c16s8s')
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def _new_id(bits):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def _is_id(value, length):
+    return isinstance(value, str) and len(value) == length and _HEX_DIGITS.issuperset(value) and value.strip('0') != ''
+
+
+def parse_context(context):
+    """
+    Validates a trace context received from a peer: [trace id, span id] when both ids are lowercase hex of the right
+    length and not all zeros, False when the peer did not sample, None for anything else.
+    """
+    if context is False:
+        return False
+    if isinstance(context, (list, tuple)) and len(context) == 2 and _is_id(context[0], 32) and _is_id(context[1], 16):
+        return [context[0], context[1]]
+    return None
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'duration', 'tags', '_started')
+
+    def __init__(self, trace_id, parent_id, name):
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.tags = {}
+        self._started = time.perf_counter()
+
+    def child(self, name):
+        return Span(self.trace_id, self.span_id, name)
+
+    def get_context(self):
+        return [self.trace_id, self.span_id]
+
+    def to_dict(self, service=None):
+        return {
+            'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+            'service': service, 'start': self.start, 'duration': self.duration, 'tags': self.tags,
+        }
+
+
+class Tracer:
+    """
+    Records spans of the requests a process handles and the calls it makes to an exporter. Whether a trace is recorded
+    is decided once, where it starts, with probability `sample_rate`; the decision travels with the requests so
+    unsampled traces cost next to nothing downstream.
+    """
+    def __init__(self, exporter=None, sample_rate=0.01, service=None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.service = service
+
+    def start_span(self, name, context=None):
+        """
+        A span continuing `context` (the [trace id, span id] of the caller), NOT_SAMPLED when the caller decided not to
+        sample (False) or, without a valid context, a new trace if it is sampled.
+        """
+        context = parse_context(context)
+        if context is False:
+            return NOT_SAMPLED
+        if context:
+            return Span(context[0], context[1], name)
+        if random.random() < self.sample_rate:
+            return Span(_new_id(128), None, name)
+        return NOT_SAMPLED
+
+    def finish(self, span):
+        span.duration = time.perf_counter() - span._started
+        if self.exporter is not None:
+            self.exporter.export(span.to_dict(self.service))
+
+    def close(self):
+        """
+        Lets the exporter write out the spans it still holds.
+        """
+        close = getattr(self.exporter, 'close', None)
+        if close is not None:
+            close()
+
+
+def start_span(name, context=None):
+    """
+    Starts a span for a request or notification being handled and makes it the current one. Returns a token for
+    finish_span, or None when tracing is off.
+    """
+    if _tracer is None:
+        return None
+    return current_span.set(_tracer.start_span(name, context))
+
+
+def finish_span(token, **tags):
+    if token is None:
+        return
+    span = current_span.get()
+    current_span.reset(token)
+    if span is not NOT_SAMPLED:
+        span.tags.update(tags)
+        _tracer.finish(span)
+
+
+def set_tags(**tags):
+    span = current_span.get()
+    if span is not None and span is not NOT_SAMPLED:
+        span.tags.update(tags)
+
+
+def start_child(name):
+    """
+    A span for an outgoing call made while handling a sampled request, else None.
+    """
+    span = current_span.get()
+    if span is None or span is NOT_SAMPLED:
+        return None
+    return span.child(name)
+
+
+def finish_child(span, **tags):
+    if span is not None and _tracer is not None:
+        span.tags.update(tags)
+        _tracer.finish(span)
+
+
+def get_outgoing_context(child=None):
+    """
+    The trace context to send along with an outgoing call: the child span's, False when the current trace is not
+    sampled and None outside of any trace.
+    """
+    if child is not None:
+        return child.get_context()
+    span = current_span.get()
+    if span is None:
+        return None
+    return False if span is NOT_SAMPLED else span.get_context()
+
+
+def wrap_notification(payload, span=None):
+    """
+    Prefixes a notification with the trace context of `span`, by default the current one, when the trace is sampled.
+    """
+    if span is None:
+        span = current_span.get()
+    if span is None or span is NOT_SAMPLED or parse_context(span.get_context()) is None:
+        return payload
+    header = _NOTIFICATION_HEADER.pack(TRACE_MARKER, bytes.fromhex(span.trace_id), bytes.fromhex(span.span_id))
+    return header + payload
+
+
+def unwrap_notification(data):
+    """
+    Returns the trace context a notification was published in (None if it has none) and its payload.
+    """
+    if data[:1] != TRACE_MARKER or len(data) < _NOTIFICATION_HEADER.size:
+        return None, data
+    _, trace_id, span_id = _NOTIFICATION_HEADER.unpack_from(data)
+    return [trace_id.hex(), span_id.hex()], data[_NOTIFICATION_HEADER.size:]
+
+
+def parse_traceparent(header):
+    """
+    Trace context of a W3C traceparent header ('00-<trace id>-<span id>-<flags>'), False when it is marked as not
+    sampled, None when there is no valid header.
+    """
+    parts = header.split('-') if isinstance(header, str) else ()
+    if len(parts) != 4 or len(parts[0]) != 2 or parts[0] == 'ff' or len(parts[3]) != 2:
+        return None
+    context = parse_context(parts[1:3])
+    if context is None:
+        return None
+    try:
+        sampled = int(parts[3], 16) & 1
+    except ValueError:
+        return None
+    return context if sampled else False
+
+
+class JsonLinesExporter:
+    """
+    Appends finished spans as JSON lines to `path`, from a thread of its own. Up to `max_queued` spans wait to be
+    written, spans beyond that are dropped and counted in `dropped`.
+    """
+    def __init__(self, path, max_queued=10000):
+        self._path = path
+        self._queue = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self._logger = logging.getLogger('mited.JsonLinesExporter')
+        self._writer = ProcessThread(self._write, 'mited-trace-exporter')
+
+    def export(self, span):
+        if not self._writer.running:
+            self._writer.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._writer.running:
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write(self):
+        with open(self._path, 'a') as f:
+            while True:
+                spans = [self._queue.get()]
+                while not self._queue.empty() and len(spans) < 1000:
+                    spans.append(self._queue.get_nowait())
+                done = None in spans
+                lines = [json.dumps(span, default=str) + '\n' for span in spans if span is not None]
+                try:
+                    f.writelines(lines)
+                    f.flush()
+                except OSError:
+                    self._logger.exception('Could not write %s spans', len(lines))
+                if done:
+                    return
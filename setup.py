@@ -8,12 +8,17 @@ setup(
     description='Api and service infrastructure library for X1 (based on sanic and nats)',
     url='https://github.com/twoporeguys/miteD/',
     keywords='miteD',
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     author='Harry Winters',
     author_email='harry.winters@twoporeguys.com',
     install_requires=[
         'requests==2.20.1',
         'sanic==0.8.3',
         'asyncio-nats-streaming==0.1.2'
-    ]
+    ],
+    extras_require={
+        'msgpack': ['msgpack>=0.6'],
+        'orjson': ['orjson>=3.0'],
+        'uvloop': ['uvloop>=0.12'],
+    }
 )
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import tracemalloc
+import unittest
+
+from miteD.service import chunking
+from miteD.service.chunking import ChunkReceiver, MalformedChunk, TransferTooLarge, MIN_CHUNK_SIZE
+
+
+def make_chunk(transfer_id, offset, total, data):
+    return chunking._HEADER.pack(chunking.CHUNK_MARKER, transfer_id, offset, total) + data
+
+
+class ChunkReceiverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_reassembles_chunks_in_any_order(self):
+        payload = os.urandom(5 * MIN_CHUNK_SIZE + 10)
+        chunks = chunking.split(payload, MIN_CHUNK_SIZE)
+        receiver = ChunkReceiver(chunks[0])
+        for chunk in reversed(chunks[1:]):
+            self.assertFalse(receiver.complete)
+            receiver.add(chunk)
+        self.assertTrue(receiver.complete)
+        self.assertEqual(receiver.data, payload)
+
+    def test_small_payload_fits_in_one_chunk(self):
+        receiver = ChunkReceiver(chunking.split(b'abc', MIN_CHUNK_SIZE)[0])
+        self.assertTrue(receiver.complete)
+        self.assertEqual(receiver.data, b'abc')
+
+    def test_rejects_chunks_below_the_minimum_size(self):
+        total = chunking.DEFAULT_MAX_TRANSFER_SIZE
+        tracemalloc.start()
+        try:
+            with self.assertRaises(MalformedChunk):
+                ChunkReceiver(make_chunk(b'x' * 16, 0, total, b'a'))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, MIN_CHUNK_SIZE * 64)
+
+    def test_tracks_chunks_in_a_bitmap(self):
+        total = chunking.DEFAULT_MAX_TRANSFER_SIZE
+        tracemalloc.start()
+        try:
+            receiver = ChunkReceiver(make_chunk(b'x' * 16, 0, total, bytes(MIN_CHUNK_SIZE)))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertFalse(receiver.complete)
+        self.assertLess(peak, total + total // MIN_CHUNK_SIZE + MIN_CHUNK_SIZE * 64)
+
+    def test_rejects_oversized_transfers(self):
+        with self.assertRaises(TransferTooLarge):
+            ChunkReceiver(make_chunk(b'x' * 16, 0, 10 * MIN_CHUNK_SIZE, bytes(MIN_CHUNK_SIZE)), 5 * MIN_CHUNK_SIZE)
+
+    def test_rejects_a_first_chunk_that_does_not_start_the_payload(self):
+        with self.assertRaises(MalformedChunk):
+            ChunkReceiver(make_chunk(b'x' * 16, MIN_CHUNK_SIZE, 2 * MIN_CHUNK_SIZE, bytes(MIN_CHUNK_SIZE)))
+        with self.assertRaises(MalformedChunk):
+            ChunkReceiver(make_chunk(b'x' * 16, 0, 10, bytes(MIN_CHUNK_SIZE)))
+        with self.assertRaises(MalformedChunk):
+            ChunkReceiver(b'\x02')
+
+    def test_ignores_out_of_bounds_and_misaligned_chunks(self):
+        transfer_id = b'x' * 16
+        total = 2 * MIN_CHUNK_SIZE
+        receiver = ChunkReceiver(make_chunk(transfer_id, 0, total, bytes(MIN_CHUNK_SIZE)))
+        for offset in (total, 2 * total, 2 ** 63, MIN_CHUNK_SIZE // 2):
+            receiver.add(make_chunk(transfer_id, offset, total, b'\xff' * MIN_CHUNK_SIZE))
+        receiver.add(make_chunk(b'y' * 16, MIN_CHUNK_SIZE, total, b'\xff' * MIN_CHUNK_SIZE))
+        receiver.add(make_chunk(transfer_id, MIN_CHUNK_SIZE, total, b'\xff'))
+        self.assertFalse(receiver.complete)
+        self.assertEqual(receiver.data, bytes(total))
+        receiver.add(make_chunk(transfer_id, MIN_CHUNK_SIZE, total, b'\x01' * MIN_CHUNK_SIZE))
+        self.assertTrue(receiver.complete)
+        self.assertEqual(receiver.data, bytes(MIN_CHUNK_SIZE) + b'\x01' * MIN_CHUNK_SIZE)
+
+    def test_ignores_repeated_chunks(self):
+        transfer_id = b'x' * 16
+        total = 3 * MIN_CHUNK_SIZE
+        receiver = ChunkReceiver(make_chunk(transfer_id, 0, total, b'\x00' * MIN_CHUNK_SIZE))
+        for _ in range(3):
+            receiver.add(make_chunk(transfer_id, 0, total, b'\xff' * MIN_CHUNK_SIZE))
+            receiver.add(make_chunk(transfer_id, MIN_CHUNK_SIZE, total, b'\x01' * MIN_CHUNK_SIZE))
+        self.assertFalse(receiver.complete)
+        receiver.add(make_chunk(transfer_id, 2 * MIN_CHUNK_SIZE, total, b'\x02' * MIN_CHUNK_SIZE))
+        self.assertTrue(receiver.complete)
+        self.assertEqual(receiver.data, b'\x00' * MIN_CHUNK_SIZE + b'\x01' * MIN_CHUNK_SIZE + b'\x02' * MIN_CHUNK_SIZE)
+
+    def test_chunk_size_has_a_minimum(self):
+        with self.assertRaises(ValueError):
+            chunking.check_chunk_size(MIN_CHUNK_SIZE - 1)
+        self.assertEqual(chunking.check_chunk_size(MIN_CHUNK_SIZE), MIN_CHUNK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
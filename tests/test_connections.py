@@ -0,0 +1,202 @@
+import asyncio
+import itertools
+import unittest
+from functools import partial
+
+from nats.aio.errors import ErrTimeout
+
+from miteD import codecs
+from miteD.connections import ConnectionPool
+from miteD.service import chunking
+from miteD.service.client import RemoteService
+from miteD.service.service import rpc_service, rpc_method
+from miteD.service.stream import new_inbox
+
+
+class Msg:
+    def __init__(self, subject, reply, data):
+        self.subject = subject
+        self.reply = reply
+        self.data = data
+
+
+def matches(pattern, subject):
+    pattern, subject = pattern.split('.'), subject.split('.')
+    return len(pattern) == len(subject) and all(p in ('*', s) for p, s in zip(pattern, subject))
+
+
+class Broker:
+    """
+    Delivers messages to the subscriptions it has read so far. Each connection is read in order, but some connections
+    are read slower than others, so operations sent on different connections can be applied out of order.
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self._sids = itertools.count(1)
+        self._latencies = itertools.cycle((0.02, 0.0, 0.01, 0.0))
+
+    def client(self):
+        return FakeClient(self, next(self._latencies))
+
+    def add(self, sid, subject, queue, cb):
+        self.subscriptions[sid] = (subject, queue, cb)
+
+    def remove(self, sid):
+        self.subscriptions.pop(sid, None)
+
+    def deliver(self, msg):
+        queues = set()
+        for subject, queue, cb in list(self.subscriptions.values()):
+            if not matches(subject, msg.subject) or queue in queues:
+                continue
+            if queue:
+                queues.add(queue)
+            asyncio.ensure_future(cb(msg))
+
+
+class FakeClient:
+    """
+    Like the NATS client, queues its operations to be sent to the broker instead of waiting for them to be applied.
+    """
+    def __init__(self, broker, latency):
+        self._broker = broker
+        self._latency = latency
+        self._outgoing = None
+        self._reader = None
+        self.is_connected = False
+
+    async def connect(self, **options):
+        self._outgoing = asyncio.Queue()
+        self._reader = asyncio.ensure_future(self._read())
+        self.is_connected = True
+
+    async def _read(self):
+        while True:
+            operation = await self._outgoing.get()
+            await asyncio.sleep(self._latency)
+            operation()
+
+    async def subscribe(self, subject, queue='', cb=None, **options):
+        sid = next(self._broker._sids)
+        self._outgoing.put_nowait(partial(self._broker.add, sid, subject, queue, cb))
+        return sid
+
+    async def unsubscribe(self, sid, max_msgs=0):
+        self._outgoing.put_nowait(partial(self._broker.remove, sid))
+
+    async def publish(self, subject, payload):
+        await self.publish_request(subject, '', payload)
+
+    async def publish_request(self, subject, reply, payload):
+        self._outgoing.put_nowait(partial(self._broker.deliver, Msg(subject, reply, payload)))
+
+    async def timed_request(self, subject, payload, timeout=0.5):
+        reply = asyncio.get_event_loop().create_future()
+
+        async def on_reply(msg):
+            if not reply.done():
+                reply.set_result(msg)
+
+        inbox = new_inbox()
+        sid = await self.subscribe(inbox, cb=on_reply)
+        await self.publish_request(subject, inbox, payload)
+        try:
+            return await asyncio.wait_for(reply, timeout)
+        except asyncio.TimeoutError:
+            raise ErrTimeout
+        finally:
+            await self.unsubscribe(sid)
+
+    async def flush(self, timeout=60):
+        flushed = asyncio.get_event_loop().create_future()
+        self._outgoing.put_nowait(partial(flushed.set_result, None))
+        await asyncio.wait_for(flushed, timeout)
+
+    async def close(self):
+        self._reader.cancel()
+        self.is_connected = False
+
+
+@rpc_service(name='pooled', versions=['1.0'], connections=4, chunk_size=1024)
+class Pooled:
+    @rpc_method()
+    async def echo(self, data):
+        return data
+
+    @rpc_method()
+    async def count(self, n):
+        for i in range(n):
+            yield i
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.broker = Broker()
+
+    def tearDown(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10))
+
+    async def connect_pool(self, size):
+        pool = ConnectionPool(size, self.broker.client)
+        await pool.connect()
+        return pool
+
+    def test_reply_inbox_is_subscribed_before_the_request_arrives(self):
+        async def run():
+            responder = await self.connect_pool(4)
+            requester = await self.connect_pool(4)
+
+            async def on_request(msg):
+                await responder.publish(msg.reply, msg.data)
+
+            await responder.subscribe('pooled.ping.*', cb=on_request)
+            await asyncio.sleep(0.1)
+            replies = asyncio.Queue()
+            for index in range(20):
+                inbox = new_inbox()
+                await requester.subscribe(inbox, cb=replies.put)
+                await requester.publish_request('pooled.ping.{}'.format(index), inbox, str(index).encode())
+            received = [await asyncio.wait_for(replies.get(), 2) for _ in range(20)]
+            self.assertEqual(sorted(int(msg.data) for msg in received), list(range(20)))
+
+        self.run_async(run())
+
+    def test_chunked_calls_and_streams(self):
+        async def run():
+            service = Pooled()
+            service._nc = await self.connect_pool(4)
+            await service._expose_api_version('pooled', '1_0')
+            await asyncio.sleep(0.1)
+            client = RemoteService('pooled', '1.0', await self.connect_pool(3), timeout=2, chunk_size=1024)
+            for size in (10, 5000):
+                self.assertEqual(await client.echo('x' * size), 'x' * size)
+            self.assertEqual([i async for i in client.count.stream(50, window=4)], list(range(50)))
+
+        self.run_async(run())
+
+    def test_replies_are_only_chunked_for_callers_that_reassemble_them(self):
+        async def run():
+            service = Pooled()
+            service._nc = await self.connect_pool(4)
+            await service._expose_api_version('pooled', '1_0')
+            await asyncio.sleep(0.1)
+            requester = await self.connect_pool(2)
+            reply = await requester.timed_request('rpc.service.pooled.1_0.echo', codecs.encode(['x' * 5000]), 2)
+            self.assertFalse(chunking.is_chunk(reply.data))
+            self.assertEqual(codecs.decode(reply.data)[1]['body'], 'x' * 5000)
+            client = RemoteService('pooled', '1.0', requester, timeout=2, chunk_size=1024)
+            self.assertEqual([item async for item in client.echo.stream('y' * 5000)], ['y' * 5000])
+
+        self.run_async(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from miteD.middleware.consul import ConsulClient, ConsulKeepAlive
+
+
+class Agent:
+    """
+    Stands in for the consul agent: records the requests it gets and answers them with the status `respond` returns
+    for their path, after `delay` seconds.
+    """
+    def __init__(self):
+        self.requests = []
+        self.services = {}
+        self.delay = 0
+        self.failing = False
+
+    def respond(self, path, body):
+        self.requests.append(path)
+        if self.failing:
+            return 500
+        if path == '/v1/agent/service/register':
+            registration = json.loads(body)
+            self.services[registration['ID']] = registration
+            return 200
+        if path.startswith('/v1/agent/service/deregister/'):
+            return 200 if self.services.pop(path.rsplit('/', 1)[1], None) else 404
+        if path.startswith('/v1/agent/check/pass/'):
+            check_id = path.rsplit('/', 1)[1]
+            known = any(service['Check']['CheckID'] == check_id for service in self.services.values())
+            return 200 if known else 404
+        return 404
+
+
+def serve(agent):
+    class Handler(BaseHTTPRequestHandler):
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            time.sleep(agent.delay)
+            self.send_response(agent.respond(self.path, body))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+REGISTRATION = {'ID': 'api-1', 'Name': 'api', 'Check': {'CheckID': 'api-1-ttl', 'TTL': '60s'}}
+
+
+class ConsulKeepAliveTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.agent = Agent()
+        self.server = serve(self.agent)
+        self.client = ConsulClient('http://127.0.0.1:{}/'.format(self.server.server_port), timeout=5)
+        self.keep_alive = ConsulKeepAlive(self.client, REGISTRATION, interval=0.05, retries=3, backoff=0.05)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10))
+
+    def test_registers_then_passes_its_check(self):
+        async def run():
+            self.keep_alive.start()
+            await asyncio.sleep(0.2)
+            await self.keep_alive.close()
+
+        self.run_async(run())
+        self.assertEqual(self.agent.requests[0], '/v1/agent/service/register')
+        self.assertGreater(self.agent.requests.count('/v1/agent/check/pass/api-1-ttl'), 1)
+        self.assertEqual(self.agent.requests[-1], '/v1/agent/service/deregister/api-1')
+        self.assertEqual(self.agent.services, {})
+        self.assertFalse(self.keep_alive.registered)
+        self.assertEqual(self.keep_alive.failures, 0)
+
+    def test_registers_again_when_consul_forgot_the_check(self):
+        async def run():
+            await self.keep_alive._with_retries(self.keep_alive._check_in)
+            self.agent.services.clear()
+            await self.keep_alive._with_retries(self.keep_alive._check_in)
+
+        self.run_async(run())
+        self.assertEqual(self.agent.requests, [
+            '/v1/agent/service/register',
+            '/v1/agent/check/pass/api-1-ttl',
+            '/v1/agent/check/pass/api-1-ttl',
+            '/v1/agent/service/register',
+            '/v1/agent/check/pass/api-1-ttl',
+        ])
+        self.assertIn('api-1', self.agent.services)
+        self.assertTrue(self.keep_alive.registered)
+        self.assertEqual(self.keep_alive.failures, 1)
+
+    def test_backs_off_between_retries_then_gives_up_until_the_next_interval(self):
+        self.agent.failing = True
+        with mock.patch('miteD.middleware.consul.random.uniform', side_effect=lambda low, high: high) as uniform:
+            started = time.perf_counter()
+            self.run_async(self.keep_alive._with_retries(self.keep_alive._check_in))
+            elapsed = time.perf_counter() - started
+        self.assertEqual(len(self.agent.requests), 3)
+        self.assertEqual(self.keep_alive.failures, 3)
+        self.assertFalse(self.keep_alive.registered)
+        self.assertEqual([call.args for call in uniform.call_args_list], [(0, 0.05), (0, 0.1)])
+        self.assertGreaterEqual(elapsed, 0.15)
+
+    def test_deregistration_gives_up_after_its_timeout(self):
+        self.run_async(self.keep_alive._with_retries(self.keep_alive._check_in))
+        self.agent.delay = 1
+        started = time.perf_counter()
+        with self.assertLogs('mited.Consul', 'WARNING'):
+            self.run_async(self.keep_alive.deregister(timeout=0.1))
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertTrue(self.keep_alive.registered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+from miteD import tracing
+from miteD.service.service import rpc_service
+
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+
+
+class Exporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class Publisher:
+    def __init__(self):
+        self.published = {}
+
+    async def publish(self, subject, payload):
+        self.published[subject] = payload
+
+
+class Notifying:
+    pass
+
+
+Notifier = rpc_service(
+    name='notifier', versions=['1.0'], notification_topics=['traced', 'untraced', 'batched'],
+    notification_batching={'batched': 2}, untraced_topics=['untraced', 'batched'],
+)(Notifying)
+
+
+class TraceContextTest(unittest.TestCase):
+    def setUp(self):
+        self.exporter = Exporter()
+        tracing.set_tracer(tracing.Tracer(self.exporter, sample_rate=0))
+
+    def tearDown(self):
+        tracing.set_tracer(None)
+
+    def test_parses_traceparent_headers(self):
+        self.assertEqual(tracing.parse_traceparent('00-{}-{}-01'.format(TRACE_ID, SPAN_ID)), [TRACE_ID, SPAN_ID])
+        self.assertIs(tracing.parse_traceparent('00-{}-{}-00'.format(TRACE_ID, SPAN_ID)), False)
+
+    def test_rejects_malformed_traceparent_headers(self):
+        for header in (
+            None, '', 'garbage', '00-{}-{}'.format(TRACE_ID, SPAN_ID),
+            '00-{}-{}-01'.format('zz' * 16, SPAN_ID),
+            '00-{}-{}-01'.format(TRACE_ID, 'g' * 16),
+            '00-{}-{}-01'.format(TRACE_ID.upper(), SPAN_ID),
+            '00-{}-{}-01'.format('0' * 32, SPAN_ID),
+            '00-{}-{}-01'.format(TRACE_ID, '0' * 16),
+            '00-{}-{}-xx'.format(TRACE_ID, SPAN_ID),
+            'ff-{}-{}-01'.format(TRACE_ID, SPAN_ID),
+        ):
+            self.assertIsNone(tracing.parse_traceparent(header), header)
+
+    def test_malformed_contexts_are_ignored(self):
+        for context in ('abc', 42, {'a': 1}, [TRACE_ID], ['x' * 32, SPAN_ID], [TRACE_ID, None], ['0' * 32, SPAN_ID]):
+            token = tracing.start_span('rpc.service.a.1_0.m', context)
+            self.assertIs(tracing.current_span.get(), tracing.NOT_SAMPLED)
+            tracing.finish_span(token)
+        token = tracing.start_span('rpc.service.a.1_0.m', [TRACE_ID, SPAN_ID])
+        tracing.finish_span(token)
+        self.assertEqual([(span['trace_id'], span['parent_id']) for span in self.exporter.spans], [(TRACE_ID, SPAN_ID)])
+
+    def test_notifications_carry_the_trace_context(self):
+        token = tracing.start_span('notify', [TRACE_ID, SPAN_ID])
+        try:
+            payload = tracing.wrap_notification(b'{}')
+            span_id = tracing.current_span.get().span_id
+        finally:
+            tracing.finish_span(token)
+        self.assertEqual(tracing.unwrap_notification(payload), ([TRACE_ID, span_id], b'{}'))
+        truncated = tracing.TRACE_MARKER + b'{}'
+        self.assertEqual(tracing.unwrap_notification(truncated), (None, truncated))
+
+    def test_untraced_topics_are_published_without_the_trace_context(self):
+        async def run():
+            service = Notifier()
+            service._nc = publisher = Publisher()
+            for buffer in service._publish_buffers.values():
+                buffer._nc = publisher
+            token = tracing.start_span('notify', [TRACE_ID, SPAN_ID])
+            try:
+                for topic in ('traced', 'untraced', 'batched'):
+                    await getattr(Notifying.notify, topic)({})
+                await service._flush_notifications()
+            finally:
+                tracing.finish_span(token)
+            return publisher.published
+
+        loop = asyncio.new_event_loop()
+        try:
+            published = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertTrue(published['notification.service.notifier.traced'].startswith(tracing.TRACE_MARKER))
+        self.assertEqual(published['notification.service.notifier.untraced'], b'{}')
+        self.assertFalse(published['notification.service.notifier.batched'].startswith(tracing.TRACE_MARKER))
+
+
+if __name__ == '__main__':
+    unittest.main()